@@ -4,10 +4,11 @@ from collections import namedtuple
 
 from .client import Elasticsearch
 from .exception import (ConnectionError, NotFoundError, ConflictError,
-                        RequestError, TransportError)
+                        QueueFullError, RequestError, TransportError)
 
 __all__ = ('Elasticsearch', 'ConnectionError', 'NotFoundError',
-           'ConflictError', 'RequestError', 'TransportError')
+           'ConflictError', 'QueueFullError', 'RequestError',
+           'TransportError')
 
 
 __version__ = '0.7.2'
@@ -42,4 +43,4 @@ version_info = _parse_version(__version__)
 
 
 (Elasticsearch, ConnectionError, NotFoundError, ConflictError,
- RequestError, TransportError)
+ QueueFullError, RequestError, TransportError)
@@ -1,12 +1,11 @@
 import asyncio
-import json
 from .cat import CatClient
 from .cluster import ClusterClient
 from .indices import IndicesClient
 from .nodes import NodesClient
 from .snapshot import SnapshotClient
 from aioes.transport import Transport
-from .utils import _make_path
+from .utils import _make_path, _ndjson
 from aioes.exception import (NotFoundError, TransportError)
 
 
@@ -52,8 +51,12 @@ class Elasticsearch:
     def __repr__(self):
         return "<Elasticsearch [{!r}]>".format(self.transport)
 
+    @asyncio.coroutine
     def _bulk_body(self, body):
-        return '\n'.join(map(json.dumps, body)) + '\n'
+        # size of bulk style body is not known before encoding, it is
+        # done in executor if offloading is enabled
+        return (yield from self.transport.offload(
+            None, _ndjson, self.transport.serializer.dumps, list(body)))
 
     def close(self):
         return self.transport.close()
@@ -208,7 +211,7 @@ class Elasticsearch:
             _source_include=default, fields=default,
             parent=default, preference=default, realtime=default,
             refresh=default, routing=default, version=default,
-            version_type=default):
+            version_type=default, deadline=None):
         """
         Get a typed JSON document from the index based on its id.
         """
@@ -249,7 +252,9 @@ class Elasticsearch:
         _, data = yield from self.transport.perform_request(
             'GET',
             _make_path(index, doc_type, id),
-            params=params)
+            params=params,
+            hedge=True,
+            deadline=deadline)
 
         return data
 
@@ -380,7 +385,7 @@ class Elasticsearch:
              _source=default, _source_exclude=default,
              _source_include=default, fields=default, parent=default,
              preference=default, realtime=default, refresh=default,
-             routing=default, stored_fields=default):
+             routing=default, stored_fields=default, deadline=None):
         """
         Get multiple documents based on an index, type (optional) and ids.
         """
@@ -410,7 +415,9 @@ class Elasticsearch:
             'GET',
             _make_path(index, doc_type, '_mget'),
             params=params,
-            body=body)
+            body=body,
+            hedge=True,
+            deadline=deadline)
 
         return data
 
@@ -429,7 +436,7 @@ class Elasticsearch:
                suggest_field=default, suggest_mode=default,
                suggest_size=default, suggest_text=default,
                timeout=default, version=default,
-               stored_fields=default):
+               stored_fields=default, deadline=None):
         """
         Execute a search query and get back search hits that match the query.
         """
@@ -542,7 +549,10 @@ class Elasticsearch:
             'GET',
             _make_path(index, doc_type, '_search'),
             params=params,
-            body=body)
+            body=body,
+            # a hedge would open another scroll context and leak it
+            hedge=scroll is default,
+            deadline=deadline)
 
         return data
 
@@ -792,7 +802,7 @@ class Elasticsearch:
               allow_no_indices=default, expand_wildcards=default,
               ignore_unavailable=default, min_score=default,
               preference=default, q=default, routing=default,
-              source=default):
+              source=default, deadline=None):
         """
         Execute a query and get the number of matches for that query.
         """
@@ -825,14 +835,14 @@ class Elasticsearch:
         _, data = yield from self.transport.perform_request(
             'POST',
             _make_path(index, doc_type, '_count'),
-            params=params, body=body)
+            params=params, body=body, hedge=True, deadline=deadline)
 
         return data
 
     @asyncio.coroutine
     def bulk(self, body, index=None, doc_type=None, *,
              consistency=default, refresh=default, routing=default,
-             replication=default, timeout=default):
+             replication=default, timeout=default, deadline=None):
         """
         Perform many index/delete operations in a single API call.
         """
@@ -864,7 +874,8 @@ class Elasticsearch:
             'POST',
             _make_path(index, doc_type, '_bulk'),
             params=params,
-            body=self._bulk_body(body))
+            body=(yield from self._bulk_body(body)),
+            deadline=deadline)
 
         return data
 
@@ -895,7 +906,7 @@ class Elasticsearch:
             'POST',
             _make_path(index, doc_type, '_msearch'),
             params=params,
-            body=self._bulk_body(body))
+            body=(yield from self._bulk_body(body)))
 
         return data
 
@@ -1124,7 +1135,7 @@ class Elasticsearch:
             'GET',
             _make_path(index, doc_type, '_mpercolate'),
             params=params,
-            body=self._bulk_body(body))
+            body=(yield from self._bulk_body(body)))
 
         return data
 
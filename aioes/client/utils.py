@@ -46,6 +46,14 @@ def _make_path(*parts):
         for p in parts if p not in SKIP_IN_PATH)
 
 
+def _ndjson(dumps, lines):
+    """
+    Encode bulk style body, one JSON document per line. Module level to be
+    usable with process pool executors.
+    """
+    return b'\n'.join(map(dumps, lines)) + b'\n'
+
+
 class NamespacedClient:
 
     def __init__(self, client):
@@ -1,10 +1,12 @@
 import asyncio
-import json
+import collections
 import logging
 
 import aiohttp
 import yarl
-from .exception import HTTP_EXCEPTIONS, TransportError
+from .exception import (HTTP_EXCEPTIONS, ConnectionError, QueueFullError,
+                        SerializationError, TransportError)
+from .serializer import JSONSerializer
 
 logger = logging.getLogger(__name__)
 
@@ -17,37 +19,162 @@ class Connection:
     Also responsible for logging.
     """
 
-    def __init__(self, endpoint, *, loop, verify_ssl=True, connector=None):
+    def __init__(self, endpoint, *, loop, verify_ssl=True, connector=None,
+                 serializer=None, max_connections=None, max_pending=None,
+                 session=None):
         self._endpoint = endpoint
-        self._session = aiohttp.ClientSession(
-            # limit number of connections?
-            connector=connector or aiohttp.TCPConnector(
-                use_dns_cache=True,
-                loop=loop,
-                verify_ssl=verify_ssl),
-            loop=loop)
+        self._loop = loop
+        if serializer is None:
+            serializer = JSONSerializer()
+        self._serializer = serializer
+        # session shared with other connections is closed by its owner
+        self._owns_session = session is None
+        if session is None:
+            if connector is None:
+                kwargs = {}
+                if max_connections is not None:
+                    kwargs['limit'] = max_connections
+                connector = aiohttp.TCPConnector(
+                    use_dns_cache=True,
+                    loop=loop,
+                    verify_ssl=verify_ssl,
+                    **kwargs)
+            session = aiohttp.ClientSession(connector=connector, loop=loop)
+        self._session = session
+        self._closed = False
         self._base_url = yarl.URL('{0.scheme}://{0.host}:{0.port}/'
                                   .format(endpoint))
+        self._in_flight = 0
+        self._close_when_idle = False
+        self._max_connections = max_connections
+        self._max_pending = max_pending
+        # requests being sent and FIFO queue of waiting ones
+        self._active = 0
+        self._waiters = collections.deque()
 
     @property
     def endpoint(self):
         return self._endpoint
 
+    @property
+    def in_flight(self):
+        """Number of requests dispatched to the connection and not
+        finished yet, including queued ones."""
+        return self._in_flight
+
+    @property
+    def max_connections(self):
+        return self._max_connections
+
+    @property
+    def max_pending(self):
+        return self._max_pending
+
+    @property
+    def pending(self):
+        """Number of requests waiting for a free connection slot."""
+        return len(self._waiters)
+
+    @property
+    def closed(self):
+        return self._closed
+
     def close(self):
-        return self._session.close()
+        self._closed = True
+        if self._owns_session:
+            return self._session.close()
+
+    def close_when_idle(self):
+        """Close the connection after all in-flight requests finish."""
+        if self._in_flight:
+            self._close_when_idle = True
+        else:
+            self.close()
+
+    def dispatch(self):
+        """Count a request as in flight.
+
+        Called by transport as soon as the connection is picked, before
+        :meth:`perform_request` coroutine gets running, so selectors see
+        requests dispatched in the same loop iteration.
+        """
+        self._in_flight += 1
+
+    def finish(self):
+        """Account the end of a request counted by :meth:`dispatch`."""
+        self._in_flight -= 1
+        if self._close_when_idle and not self._in_flight:
+            self.close()
+
+    @asyncio.coroutine
+    def perform_request(self, method, url, params, body, *,
+                        headers=None, raw=False):
+        if self._max_connections is None:
+            return (yield from self._perform_request(
+                method, url, params, body, headers=headers, raw=raw))
+        yield from self._acquire()
+        try:
+            return (yield from self._perform_request(
+                method, url, params, body, headers=headers, raw=raw))
+        finally:
+            self._release()
+
+    @asyncio.coroutine
+    def _acquire(self):
+        if self._active < self._max_connections and not self._waiters:
+            self._active += 1
+            return
+        if (self._max_pending is not None and
+                len(self._waiters) >= self._max_pending):
+            raise QueueFullError(
+                'N/A', 'Too many pending requests', self._endpoint)
+        waiter = asyncio.Future(loop=self._loop)
+        self._waiters.append(waiter)
+        try:
+            # the slot is handed over by _release() without decrementing
+            # the active counter, newcomers can't jump the queue
+            yield from waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # got the slot but can't use it, pass it on
+                self._release()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    # already skipped by _release()
+                    pass
+            raise
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
 
     @asyncio.coroutine
-    def perform_request(self, method, url, params, body):
+    def _perform_request(self, method, url, params, body, *, headers, raw):
         url = self._base_url.with_path(url)
-        resp = yield from self._session.request(
-            method, url, params=params, data=body)
-        resp_body = yield from resp.text()
+        try:
+            resp = yield from self._session.request(
+                method, url, params=params, data=body, headers=headers)
+            if raw:
+                # skip charset detection and str copy, body is passed as is
+                resp_body = yield from resp.read()
+            else:
+                resp_body = yield from resp.text()
+        except (aiohttp.ClientError, OSError) as exc:
+            raise ConnectionError('N/A', str(exc), exc) from exc
         if not (200 <= resp.status <= 300):
             extra = None
             try:
-                extra = json.loads(resp_body)
-            except ValueError:
+                extra = self._serializer.loads(resp_body)
+            except SerializationError:
                 pass
+            if isinstance(resp_body, bytes):
+                resp_body = resp_body.decode('utf-8', 'replace')
             exc_class = HTTP_EXCEPTIONS.get(resp.status, TransportError)
             raise exc_class(resp.status, resp_body, extra)
         return resp.status, resp.headers, resp_body
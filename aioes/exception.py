@@ -1,7 +1,8 @@
 __all__ = [
     'ElasticsearchException',
     'TransportError', 'NotFoundError', 'ConflictError',
-    'RequestError', 'ConnectionError'
+    'RequestError', 'ConnectionError', 'QueueFullError', 'BulkIndexError',
+    'ScanError'
 ]
 
 
@@ -60,6 +61,14 @@ class ConnectionError(TransportError):
             self.error, self.info.__class__.__name__, self.info)
 
 
+class QueueFullError(TransportError):
+    """Queue full error.
+
+    Raised when limit of pending requests to a node is reached, the
+    node endpoint is available as .info.
+    """
+
+
 class NotFoundError(TransportError):
     """Exception representing a 404 status code."""
 
@@ -71,6 +80,30 @@ class ConflictError(TransportError):
 class RequestError(TransportError):
     """Exception representing a 400 status code."""
 
+
+class BulkIndexError(ElasticsearchException):
+    """Error raised by bulk helpers when some documents failed to index.
+
+    The list of failed items, as returned by ES, is available as
+    ``.errors``.
+    """
+    @property
+    def errors(self):
+        """List of errors from execution of the last chunk."""
+        return self.args[1]
+
+
+class ScanError(ElasticsearchException):
+    """Scroll error.
+
+    Raised by scan helpers when a scroll page has failed on some shards.
+    """
+    @property
+    def scroll_id(self):
+        """Scroll id of the failed request."""
+        return self.args[0]
+
+
 # more generic mappings from status_code to python exceptions
 
 
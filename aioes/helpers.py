@@ -0,0 +1,1169 @@
+import asyncio
+import collections
+import heapq
+import sys
+import time
+
+from .client.utils import _make_path
+from .exception import BulkIndexError, ScanError, TransportError
+from .log import logger
+from .retry import backoff
+from .serializer import JSONSerializer
+
+__all__ = ('expand_action', 'streaming_bulk', 'parallel_bulk', 'bulk',
+           'BulkStats', 'scan', 'sliced_scan', 'search_after', 'reindex')
+
+
+PY_352 = sys.version_info >= (3, 5, 2)
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:  # pragma: no cover
+    # Python 3.4 has no asynchronous iteration protocol,
+    # iterators can still be consumed by calling __anext__() manually
+    class StopAsyncIteration(Exception):
+        pass
+
+
+_END = object()
+
+
+@asyncio.coroutine
+def _await(awaitable):
+    # generator based coroutines have no __await__, everything else has
+    if hasattr(awaitable, '__await__'):
+        awaitable = awaitable.__await__()
+    return (yield from awaitable)
+
+
+class _AsyncIterator:
+    """Base class for helpers consumed by ``async for``.
+
+    On Python 3.4 use ``yield from it.__anext__()`` until
+    ``StopAsyncIteration`` is raised.
+    """
+
+    if PY_352:
+        def __aiter__(self):
+            return self
+    else:  # pragma: no cover
+        @asyncio.coroutine
+        def __aiter__(self):
+            return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        raise NotImplementedError  # pragma: no cover
+
+
+def _consume(fut):
+    # retrieve the result of an abandoned future to keep asyncio silent
+    if fut.done() and not fut.cancelled():
+        fut.exception()
+    else:
+        fut.cancel()
+
+
+class _ActionSource:
+    """Uniform coroutine access to plain and asynchronous iterables."""
+
+    def __init__(self, actions):
+        if hasattr(actions, '__anext__'):
+            self._aiter = actions
+            self._iter = None
+        elif hasattr(actions, '__aiter__'):
+            self._aiter = actions.__aiter__()
+            self._iter = None
+        else:
+            self._aiter = None
+            self._iter = iter(actions)
+
+    @asyncio.coroutine
+    def next(self):
+        """Return the next action or ``_END`` when exhausted."""
+        if self._aiter is None:
+            return next(self._iter, _END)
+        try:
+            return (yield from _await(self._aiter.__anext__()))
+        except StopAsyncIteration:
+            return _END
+
+
+def _dumps(serializer, data):
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return serializer.dumps(data)
+
+
+def expand_action(data):
+    """
+    From one document or action definition passed in by the user extract the
+    action/data lines needed for elasticsearch's
+    :meth:`~aioes.Elasticsearch.bulk` api.
+    """
+    # when given a string, assume user wants to index raw json
+    if isinstance(data, (str, bytes)):
+        return {'index': {}}, data
+
+    # make sure we don't alter the action
+    data = data.copy()
+    op_type = data.pop('_op_type', 'index')
+    action = {op_type: {}}
+    for key in ('_index', '_parent', '_percolate', '_routing', '_timestamp',
+                '_ttl', '_type', '_version', '_version_type', '_id',
+                '_retry_on_conflict', 'pipeline'):
+        if key in data:
+            action[op_type][key] = data.pop(key)
+
+    # no data payload for delete
+    if op_type == 'delete':
+        return action, None
+
+    return action, data.get('_source', data)
+
+
+# a single bulk action: original (action, data) pair and its encoded lines
+_BulkItem = collections.namedtuple('_BulkItem', 'action data lines size')
+
+
+class _ChunkReader:
+    """Split a stream of actions into chunks suitable for a bulk request.
+
+    A chunk is closed when it holds ``chunk_size`` actions or adding the
+    next action would make the request body exceed ``max_chunk_bytes``.
+    Only one chunk is materialized at a time.
+    """
+
+    def __init__(self, actions, *, chunk_size, max_chunk_bytes,
+                 expand_action_callback=expand_action, serializer=None):
+        self._source = _ActionSource(actions)
+        if serializer is None:
+            serializer = JSONSerializer()
+        self._serializer = serializer
+        self._chunk_size = chunk_size
+        self._max_chunk_bytes = max_chunk_bytes
+        self._expand_action = expand_action_callback
+        self._pending = None
+
+    def _encode(self, data):
+        action, data = self._expand_action(data)
+        lines = [_dumps(self._serializer, action)]
+        if data is not None:
+            lines.append(_dumps(self._serializer, data))
+        # account for the newline terminating each line
+        size = sum(len(line) + 1 for line in lines)
+        return _BulkItem(action, data, lines, size)
+
+    @asyncio.coroutine
+    def read(self):
+        """Return the next chunk as a list of items, ``None`` at the end."""
+        chunk = []
+        size = 0
+        while len(chunk) < self._chunk_size:
+            if self._pending is not None:
+                item, self._pending = self._pending, None
+            else:
+                data = yield from self._source.next()
+                if data is _END:
+                    break
+                item = self._encode(data)
+            if chunk and size + item.size > self._max_chunk_bytes:
+                self._pending = item
+                break
+            chunk.append(item)
+            size += item.size
+        return chunk or None
+
+
+def _bulk_body(chunk):
+    return b'\n'.join(line for item in chunk for line in item.lines) + b'\n'
+
+
+def _bulk_params(kwargs):
+    # ES expects literal true/false, not the 1/0 produced by Transport
+    return {k: str(v).lower() if isinstance(v, bool) else v
+            for k, v in kwargs.items()}
+
+
+def _failed_items(chunk, exc):
+    # mark all actions of the chunk as failed with the same exception
+    for item in chunk:
+        op_type, info = next(iter(item.action.items()))
+        info = dict(info, error=str(exc), status=exc.status_code,
+                    exception=exc)
+        if item.data is not None:
+            info['data'] = item.data
+        yield {op_type: info}
+
+
+@asyncio.coroutine
+def _process_bulk_chunk(client, chunk, *, path, params,
+                        raise_on_error=True, raise_on_exception=True,
+                        max_retries=0, initial_backoff=2, max_backoff=600,
+                        loop=None):
+    """
+    Send a bulk request to elasticsearch and process the output.
+
+    Items rejected with ``429 Too Many Requests`` (a full bulk queue on
+    the node) are sent again up to ``max_retries`` times with jittered
+    exponential backoff; items which succeeded are never resent.
+
+    Returns a list of ``(ok, item)`` pairs, one per action of the chunk.
+    """
+    errors = []
+    results = []
+    for attempt in range(max_retries + 1):
+        if attempt:
+            yield from asyncio.sleep(
+                backoff(attempt, initial_backoff, max_backoff), loop=loop)
+        retry = []
+        try:
+            _, resp = yield from client.transport.perform_request(
+                'POST', path, params=params, body=_bulk_body(chunk))
+        except TransportError as exc:
+            if exc.status_code == 429 and attempt < max_retries:
+                # the whole request was rejected, try it again
+                continue
+            # default behavior - just propagate exception
+            if raise_on_exception:
+                raise
+
+            # if we are not propagating, mark all actions in current chunk
+            # as failed
+            for info in _failed_items(chunk, exc):
+                errors.append(info)
+                results.append((False, info))
+            break
+
+        # go through request-response pairs and detect failures
+        for item, resp_item in zip(chunk, resp['items']):
+            op_type, info = next(iter(resp_item.items()))
+            status = info.get('status', 500)
+            ok = 200 <= status < 300
+            if status == 429 and attempt < max_retries:
+                retry.append(item)
+                continue
+            if not ok and raise_on_error:
+                errors.append({op_type: info})
+            results.append((ok, {op_type: info}))
+
+        if not retry:
+            break
+        logger.warning('%d of %d bulk items rejected, retrying '
+                       '(attempt %d of %d).',
+                       len(retry), len(chunk), attempt + 1, max_retries)
+        chunk = retry
+
+    if errors and raise_on_error:
+        raise BulkIndexError(
+            '%i document(s) failed to index.' % len(errors), errors)
+    return results
+
+
+class BulkStats:
+    """Counters collected while bulk helpers are running."""
+
+    def __init__(self):
+        self.docs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.requests = 0
+        self._started = time.monotonic()
+        self._finished = None
+
+    def __repr__(self):
+        return ('<BulkStats docs={} errors={} requests={} '
+                '{:.1f} docs/s {:.1f} bytes/s>'.format(
+                    self.docs, self.errors, self.requests,
+                    self.docs_per_sec, self.bytes_per_sec))
+
+    @property
+    def elapsed(self):
+        """Seconds since start, frozen when the helper is finished."""
+        end = self._finished if self._finished is not None \
+            else time.monotonic()
+        return end - self._started
+
+    @property
+    def docs_per_sec(self):
+        elapsed = self.elapsed
+        return self.docs / elapsed if elapsed else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed else 0.0
+
+    def add(self, chunk, results):
+        self.requests += 1
+        self.docs += len(chunk)
+        self.bytes += sum(item.size for item in chunk)
+        self.errors += sum(1 for ok, _ in results if not ok)
+
+    def finish(self):
+        if self._finished is None:
+            self._finished = time.monotonic()
+            logger.info('Bulk finished: %d docs (%d errors) in %.3f sec, '
+                        '%.1f docs/s, %.1f bytes/s',
+                        self.docs, self.errors, self.elapsed,
+                        self.docs_per_sec, self.bytes_per_sec)
+
+
+class _StreamingBulk(_AsyncIterator):
+
+    def __init__(self, client, actions, *, chunk_size, max_chunk_bytes,
+                 raise_on_error, raise_on_exception, expand_action_callback,
+                 max_retries, initial_backoff, max_backoff,
+                 index, doc_type, params, loop):
+        self._client = client
+        self._reader = _ChunkReader(
+            actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+            expand_action_callback=expand_action_callback,
+            serializer=client.transport.serializer)
+        self._raise_on_error = raise_on_error
+        self._raise_on_exception = raise_on_exception
+        self._path = _make_path(index, doc_type, '_bulk')
+        self._params = params
+        self._max_retries = max_retries
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._loop = loop
+        self._results = collections.deque()
+        self.stats = BulkStats()
+
+    @asyncio.coroutine
+    def _send(self, chunk):
+        results = yield from _process_bulk_chunk(
+            self._client, chunk,
+            path=self._path, params=self._params,
+            raise_on_error=self._raise_on_error,
+            raise_on_exception=self._raise_on_exception,
+            max_retries=self._max_retries,
+            initial_backoff=self._initial_backoff,
+            max_backoff=self._max_backoff,
+            loop=self._loop)
+        self.stats.add(chunk, results)
+        return results
+
+    @asyncio.coroutine
+    def __anext__(self):
+        while not self._results:
+            chunk = yield from self._reader.read()
+            if chunk is None:
+                self.stats.finish()
+                raise StopAsyncIteration
+            results = yield from self._send(chunk)
+            self._results.extend(results)
+        return self._results.popleft()
+
+
+class _ParallelBulk(_StreamingBulk):
+
+    def __init__(self, client, actions, *, concurrency, queue_size,
+                 **kwargs):
+        super().__init__(client, actions, **kwargs)
+        self._concurrency = concurrency
+        self._queue_size = queue_size
+        self._tasks = None
+        self._running = 0
+
+    def _start(self):
+        # chunks built by the producer, waiting for a free worker
+        self._chunks = asyncio.Queue(self._queue_size, loop=self._loop)
+        # results per chunk, waiting for the consumer
+        self._done = asyncio.Queue(self._queue_size, loop=self._loop)
+        self._tasks = [asyncio.ensure_future(self._produce(), loop=self._loop)]
+        for _ in range(self._concurrency):
+            self._tasks.append(
+                asyncio.ensure_future(self._work(), loop=self._loop))
+        self._running = self._concurrency
+
+    @asyncio.coroutine
+    def _produce(self):
+        try:
+            while True:
+                chunk = yield from self._reader.read()
+                if chunk is None:
+                    break
+                yield from self._chunks.put(chunk)
+            for _ in range(self._concurrency):
+                yield from self._chunks.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            yield from self._done.put(exc)
+
+    @asyncio.coroutine
+    def _work(self):
+        try:
+            while True:
+                chunk = yield from self._chunks.get()
+                if chunk is None:
+                    break
+                results = yield from self._send(chunk)
+                yield from self._done.put(results)
+            yield from self._done.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            yield from self._done.put(exc)
+
+    @asyncio.coroutine
+    def close(self):
+        """Stop all pending bulk requests."""
+        if self._tasks is None:
+            return
+        for task in self._tasks:
+            task.cancel()
+        yield from asyncio.wait(self._tasks, loop=self._loop)
+        self._running = 0
+        self.stats.finish()
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if self._tasks is None:
+            self._start()
+        while not self._results:
+            if not self._running:
+                self.stats.finish()
+                raise StopAsyncIteration
+            results = yield from self._done.get()
+            if results is _END:
+                self._running -= 1
+            elif isinstance(results, Exception):
+                yield from self.close()
+                raise results
+            else:
+                self._results.extend(results)
+        return self._results.popleft()
+
+
+def streaming_bulk(client, actions, *, chunk_size=500,
+                   max_chunk_bytes=100 * 1024 * 1024,
+                   raise_on_error=True, raise_on_exception=True,
+                   expand_action_callback=expand_action,
+                   max_retries=0, initial_backoff=2, max_backoff=600,
+                   index=None, doc_type=None, loop=None, **kwargs):
+    """
+    Streaming bulk consumes actions from the iterable passed in and returns
+    an asynchronous iterator over the results per action.
+
+    Actions are read lazily from ``actions``, which may be a plain or an
+    asynchronous iterable, so memory use does not depend on the number of
+    actions.
+
+    :arg client: instance of :class:`~aioes.Elasticsearch` to use
+    :arg actions: iterable containing the actions to be executed
+    :arg chunk_size: number of docs in one chunk sent to es (default: 500)
+    :arg max_chunk_bytes: the maximum size of the request in bytes
+        (default: 100MB)
+    :arg raise_on_error: raise ``BulkIndexError`` containing errors (as
+        ``.errors``) from the execution of the last chunk when some occur.
+        By default we raise.
+    :arg raise_on_exception: if ``False`` then don't propagate exceptions
+        from call to ``bulk`` and just report the items that failed as
+        failed.
+    :arg expand_action_callback: callback executed on each action passed in,
+        should return a tuple containing the action line and the data line
+        (``None`` if data line should be omitted).
+    :arg max_retries: maximum number of times a document will be retried
+        when ``429`` is received, set to 0 (default) for no retries on
+        ``429``
+    :arg initial_backoff: number of seconds we should wait before the first
+        retry. Any subsequent retries will be powers of ``initial_backoff *
+        2**retry_number``, randomized by full jitter
+    :arg max_backoff: maximum number of seconds a retry will wait
+    :arg index: default index for items which don't provide one
+    :arg doc_type: default document type for items which don't provide one
+
+    Any additional keyword arguments are passed to the bulk API as query
+    parameters (e.g. ``refresh`` or ``timeout``).
+    """
+    return _StreamingBulk(
+        client, actions,
+        chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+        raise_on_error=raise_on_error, raise_on_exception=raise_on_exception,
+        expand_action_callback=expand_action_callback,
+        max_retries=max_retries, initial_backoff=initial_backoff,
+        max_backoff=max_backoff,
+        index=index, doc_type=doc_type, params=_bulk_params(kwargs),
+        loop=loop)
+
+
+def parallel_bulk(client, actions, *, concurrency=4,
+                  queue_size=None, chunk_size=500,
+                  max_chunk_bytes=100 * 1024 * 1024,
+                  raise_on_error=True, raise_on_exception=True,
+                  expand_action_callback=expand_action,
+                  max_retries=0, initial_backoff=2, max_backoff=600,
+                  index=None, doc_type=None, loop=None, **kwargs):
+    """
+    Parallel version of :func:`streaming_bulk`.
+
+    Runs ``concurrency`` bulk workers, so at most that many bulk requests
+    are in flight in total. Requests are spread over the connections by
+    the pool selector; use ``max_connections_per_node`` transport
+    parameter to bound them per node. Chunks are prepared ahead of time
+    by a single producer but no more than ``queue_size`` of them are
+    waiting at once, so a fast source of actions cannot exhaust memory.
+
+    Results are yielded in the order chunks complete. Throughput counters
+    are available as ``.stats`` (:class:`BulkStats`) and logged when the
+    iterator is exhausted. Call ``close()`` to abort the pipeline when
+    stopping iteration early.
+
+    :arg concurrency: number of bulk requests in flight at once
+    :arg queue_size: number of chunks waiting to be sent or consumed,
+        defaults to ``concurrency``
+
+    Other arguments have the same meaning as in :func:`streaming_bulk`.
+    """
+    concurrency = max(1, concurrency)
+    if queue_size is None:
+        queue_size = concurrency
+    return _ParallelBulk(
+        client, actions,
+        concurrency=concurrency, queue_size=queue_size,
+        chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+        raise_on_error=raise_on_error, raise_on_exception=raise_on_exception,
+        expand_action_callback=expand_action_callback,
+        max_retries=max_retries, initial_backoff=initial_backoff,
+        max_backoff=max_backoff,
+        index=index, doc_type=doc_type, params=_bulk_params(kwargs),
+        loop=loop)
+
+
+@asyncio.coroutine
+def bulk(client, actions, *, stats_only=False, **kwargs):
+    """
+    Helper for the :meth:`~aioes.Elasticsearch.bulk` api that provides
+    a more human friendly interface - it consumes an iterator of actions and
+    sends them to elasticsearch in chunks. It returns a tuple with summary
+    information - number of successfully executed actions and either list of
+    errors or number of errors if ``stats_only`` is set to ``True``.
+
+    :arg client: instance of :class:`~aioes.Elasticsearch` to use
+    :arg actions: iterator containing the actions
+    :arg stats_only: if ``True`` only report number of successful/failed
+        operations instead of just number of successful and a list of error
+        responses
+
+    Any additional keyword arguments will be passed to
+    :func:`streaming_bulk` which is used to execute the operation.
+    """
+    success, failed = 0, 0
+
+    # list of errors to be collected is not stats_only
+    errors = []
+
+    results = streaming_bulk(client, actions, **kwargs)
+    while True:
+        try:
+            ok, item = yield from results.__anext__()
+        except StopAsyncIteration:
+            break
+        # go through request-response pairs and detect failures
+        if not ok:
+            if not stats_only:
+                errors.append(item)
+            failed += 1
+        else:
+            success += 1
+
+    return success, failed if stats_only else errors
+
+
+class _Scan(_AsyncIterator):
+
+    def __init__(self, client, *, index, doc_type, query, scroll, size,
+                 preserve_order, clear_scroll, raise_on_error, prefetch,
+                 loop, kwargs):
+        self._client = client
+        self._index = index
+        self._doc_type = doc_type
+        if not preserve_order:
+            query = query.copy() if query else {}
+            query['sort'] = '_doc'
+        self._query = query
+        self._scroll = scroll
+        self._size = size
+        self._clear_scroll = clear_scroll
+        self._raise_on_error = raise_on_error
+        self._prefetch = prefetch
+        self._loop = loop
+        self._kwargs = kwargs
+        self._hits = collections.deque()
+        self._scroll_id = None
+        self._next_page = None
+        self._started = False
+        self._finished = False
+
+    @property
+    def scroll_id(self):
+        """Scroll id of the last received page."""
+        return self._scroll_id
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        yield from self.close()
+
+    @asyncio.coroutine
+    def _first_page(self):
+        return (yield from self._client.search(
+            self._index, self._doc_type, self._query,
+            scroll=self._scroll, size=self._size, **self._kwargs))
+
+    def _fetch_next(self):
+        self._next_page = asyncio.ensure_future(
+            self._client.scroll(self._scroll_id, scroll=self._scroll),
+            loop=self._loop)
+
+    def _handle_page(self, resp):
+        self._scroll_id = resp.get('_scroll_id')
+        shards = resp.get('_shards', {})
+        if shards.get('failed'):
+            msg = ('Scroll request has failed on {} shards '
+                   'out of {}.'.format(shards['failed'], shards['total']))
+            logger.warning(msg)
+            if self._raise_on_error:
+                raise ScanError(self._scroll_id, msg)
+        hits = resp['hits']['hits']
+        if not hits or self._scroll_id is None:
+            self._finished = True
+        elif self._prefetch:
+            # ask for the next page while the caller processes this one
+            self._fetch_next()
+        return hits
+
+    @asyncio.coroutine
+    def _read_page(self):
+        """Return hits of the next page, ``None`` when scrolling is done."""
+        try:
+            hits = None
+            while not hits:
+                if not self._started:
+                    self._started = True
+                    resp = yield from self._first_page()
+                elif self._finished:
+                    yield from self.close()
+                    return None
+                else:
+                    if self._next_page is None:
+                        self._fetch_next()
+                    page, self._next_page = self._next_page, None
+                    resp = yield from page
+                hits = self._handle_page(resp)
+            return hits
+        except (Exception, asyncio.CancelledError):
+            yield from self.close()
+            raise
+
+    @asyncio.coroutine
+    def __anext__(self):
+        while not self._hits:
+            hits = yield from self._read_page()
+            if hits is None:
+                raise StopAsyncIteration
+            self._hits.extend(hits)
+        return self._hits.popleft()
+
+    @asyncio.coroutine
+    def close(self):
+        """Stop scrolling and release the search context on the server.
+
+        Called automatically when the iterator is exhausted, fails or is
+        cancelled; call it explicitly when stopping iteration early.
+        """
+        self._finished = True
+        self._hits.clear()
+        if self._next_page is not None:
+            _consume(self._next_page)
+            self._next_page = None
+        scroll_id, self._scroll_id = self._scroll_id, None
+        if scroll_id and self._clear_scroll:
+            try:
+                yield from self._client.clear_scroll(scroll_id)
+            except TransportError as exc:
+                logger.warning('Failed to clear scroll %s: %s',
+                               scroll_id, exc)
+
+
+def scan(client, index=None, query=None, *, doc_type=None, scroll='5m',
+         size=1000, preserve_order=False, clear_scroll=True,
+         raise_on_error=True, prefetch=True, loop=None, **kwargs):
+    """
+    Simple abstraction on top of the
+    :meth:`~aioes.Elasticsearch.scroll` api - an asynchronous iterator that
+    yields all hits as returned by underlining scroll requests.
+
+    The next page is requested as soon as the current one arrives, so
+    network round trips overlap with processing of hits. The scroll
+    context is cleared when iteration ends, fails or is cancelled; the
+    iterator is also an asynchronous context manager for early exits::
+
+        async with scan(es, 'index', {'query': {'match_all': {}}}) as hits:
+            async for hit in hits:
+                ...
+
+    By default scan does not return results in any pre-determined order.
+    To have a standard order in the returned documents (either by score or
+    explicit sort definition) when scrolling, use ``preserve_order=True``.
+    This may be an expensive operation and will negate the performance
+    benefits of using ``scan``.
+
+    :arg client: instance of :class:`~aioes.Elasticsearch` to use
+    :arg index: index (or list of indices) to scroll over
+    :arg query: body for the :meth:`~aioes.Elasticsearch.search` api
+    :arg doc_type: document type to restrict the search to
+    :arg scroll: Specify how long a consistent view of the index should be
+        maintained for scrolled search
+    :arg size: size (per shard) of the batch send at each iteration.
+    :arg preserve_order: don't set the ``sort`` parameter to ``_doc``
+    :arg clear_scroll: explicitly calls ``clear_scroll`` on the scroll id
+        when done
+    :arg raise_on_error: raises an exception (``ScanError``) if an error is
+        encountered (some shards fail to execute). By default we raise.
+    :arg prefetch: request the next page in background while the current
+        one is consumed
+
+    Any additional keyword arguments will be passed to the initial
+    :meth:`~aioes.Elasticsearch.search` call.
+    """
+    return _Scan(client, index=index, doc_type=doc_type, query=query,
+                 scroll=scroll, size=size, preserve_order=preserve_order,
+                 clear_scroll=clear_scroll, raise_on_error=raise_on_error,
+                 prefetch=prefetch, loop=loop, kwargs=kwargs)
+
+
+class _Desc:
+    """Invert ordering of a sort value for descending fields."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _sort_fields(sort):
+    if not isinstance(sort, (list, tuple)):
+        sort = [sort]
+    for item in sort:
+        if isinstance(item, str):
+            yield item
+        else:
+            yield next(iter(item))
+
+
+def _sort_key(sort):
+    """Build a key function ordering hits like ES does for ``sort``."""
+    if not isinstance(sort, (list, tuple)):
+        sort = [sort]
+    descending = []
+    for item in sort:
+        if isinstance(item, str):
+            field, order = item, None
+        else:
+            field, order = next(iter(item.items()))
+            if isinstance(order, dict):
+                order = order.get('order')
+        if order is None:
+            order = 'desc' if field == '_score' else 'asc'
+        descending.append(order == 'desc')
+
+    def key(hit):
+        return tuple(_Desc(value) if desc else value
+                     for value, desc in zip(hit['sort'], descending))
+    return key
+
+
+class _SlicedScan(_AsyncIterator):
+
+    def __init__(self, client, *, index, doc_type, query, slices, ordered,
+                 queue_size, loop, kwargs):
+        if ordered:
+            if not query or 'sort' not in query:
+                raise ValueError("Ordered sliced scan requires "
+                                 "explicit 'sort' in query")
+            kwargs['preserve_order'] = True
+            self._key = _sort_key(query['sort'])
+        self._client = client
+        self._index = index
+        self._doc_type = doc_type
+        self._query = query
+        self._slices = slices
+        self._ordered = ordered
+        self._queue_size = queue_size
+        self._loop = loop
+        self._kwargs = kwargs
+        self._scans = None
+        self._tasks = []
+        self._hits = collections.deque()
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        yield from self.close()
+
+    @asyncio.coroutine
+    def _start(self):
+        slices = self._slices
+        if slices is None:
+            # one slice per shard
+            resp = yield from self._client.search_shards(
+                self._index, self._doc_type)
+            slices = len(resp['shards'])
+        self._scans = []
+        for i in range(slices):
+            query = dict(self._query or {})
+            # ES refuses slicing into a single slice
+            if slices > 1:
+                query['slice'] = {'id': i, 'max': slices}
+            self._scans.append(scan(
+                self._client, self._index, query, doc_type=self._doc_type,
+                loop=self._loop, **self._kwargs))
+        if self._ordered:
+            yield from self._start_ordered()
+        else:
+            self._start_unordered(slices)
+
+    # unordered merge: every slice pumps pages into the shared queue
+
+    def _start_unordered(self, slices):
+        queue_size = self._queue_size
+        if queue_size is None:
+            queue_size = slices
+        self._pages = asyncio.Queue(queue_size, loop=self._loop)
+        self._running = slices
+        self._tasks = [asyncio.ensure_future(self._pump(scan), loop=self._loop)
+                       for scan in self._scans]
+
+    @asyncio.coroutine
+    def _pump(self, scan):
+        try:
+            while True:
+                hits = yield from scan._read_page()
+                if hits is None:
+                    break
+                yield from self._pages.put(hits)
+            yield from self._pages.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            yield from self._pages.put(exc)
+
+    @asyncio.coroutine
+    def _next_unordered(self):
+        while not self._hits:
+            if not self._running:
+                raise StopAsyncIteration
+            hits = yield from self._pages.get()
+            if hits is _END:
+                self._running -= 1
+            elif isinstance(hits, Exception):
+                yield from self.close()
+                raise hits
+            else:
+                self._hits.extend(hits)
+        return self._hits.popleft()
+
+    # ordered merge: heap of the current head hit of every slice
+
+    @asyncio.coroutine
+    def _advance(self, i):
+        try:
+            hit = yield from self._scans[i].__anext__()
+        except StopAsyncIteration:
+            return
+        heapq.heappush(self._heap, (self._key(hit), i, hit))
+
+    @asyncio.coroutine
+    def _start_ordered(self):
+        self._heap = []
+        yield from asyncio.gather(
+            *[self._advance(i) for i in range(len(self._scans))],
+            loop=self._loop)
+
+    @asyncio.coroutine
+    def _next_ordered(self):
+        if not self._heap:
+            raise StopAsyncIteration
+        _, i, hit = heapq.heappop(self._heap)
+        yield from self._advance(i)
+        return hit
+
+    @asyncio.coroutine
+    def __anext__(self):
+        try:
+            if self._scans is None:
+                yield from self._start()
+            if self._ordered:
+                return (yield from self._next_ordered())
+            else:
+                return (yield from self._next_unordered())
+        except StopAsyncIteration:
+            raise
+        except (Exception, asyncio.CancelledError):
+            yield from self.close()
+            raise
+
+    @asyncio.coroutine
+    def close(self):
+        """Stop all slices and clear their scroll contexts."""
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            yield from asyncio.wait(self._tasks, loop=self._loop)
+        self._tasks = []
+        self._hits.clear()
+        if self._scans:
+            yield from asyncio.gather(*[scan.close() for scan in self._scans],
+                                      loop=self._loop)
+
+
+def sliced_scan(client, index=None, query=None, *, doc_type=None,
+                slices=None, ordered=False, queue_size=None, loop=None,
+                **kwargs):
+    """
+    Export all documents matching ``query`` through several concurrent
+    sliced scrolls merged into a single asynchronous iterator.
+
+    Every slice is an independent :func:`scan` so slices are served by
+    different shards and, through the connection pool, different nodes.
+
+    :arg client: instance of :class:`~aioes.Elasticsearch` to use
+    :arg index: index (or list of indices) to scroll over
+    :arg query: body for the :meth:`~aioes.Elasticsearch.search` api
+    :arg doc_type: document type to restrict the search to
+    :arg slices: number of slices, by default one per shard of ``index``
+        as reported by :meth:`~aioes.Elasticsearch.search_shards`
+    :arg ordered: if ``True`` merge hits of all slices according to the
+        ``sort`` of ``query`` (which is required then), otherwise hits are
+        yielded as soon as any slice delivers them
+    :arg queue_size: number of pages buffered in unordered mode, one per
+        slice by default
+
+    Any additional keyword arguments (``scroll``, ``size`` etc.) are passed
+    to :func:`scan` used for every slice. Requires Elasticsearch 5.0+.
+    """
+    return _SlicedScan(client, index=index, doc_type=doc_type, query=query,
+                       slices=slices, ordered=ordered, queue_size=queue_size,
+                       loop=loop, kwargs=kwargs)
+
+
+class _SearchAfter(_AsyncIterator):
+
+    def __init__(self, client, *, index, doc_type, query, sort, tiebreaker,
+                 size, cursor, prefetch, loop, kwargs):
+        query = dict(query or {})
+        sort = query.pop('sort', sort) or []
+        if not isinstance(sort, (list, tuple)):
+            sort = [sort]
+        sort = list(sort)
+        if tiebreaker not in _sort_fields(sort):
+            # a unique field makes the order total, no hits are skipped
+            # or repeated between pages
+            sort.append({tiebreaker: 'asc'})
+        query['sort'] = sort
+        query['size'] = size
+        self._client = client
+        self._index = index
+        self._doc_type = doc_type
+        self._query = query
+        self._size = size
+        self._prefetch = prefetch
+        self._loop = loop
+        self._kwargs = kwargs
+        self._cursor = cursor
+        self._hits = collections.deque()
+        self._next_page = None
+        self._started = False
+        self._finished = False
+
+    @property
+    def cursor(self):
+        """Sort values of the last returned hit.
+
+        Pass it as ``cursor`` to :func:`search_after` to continue right
+        after that hit.
+        """
+        return self._cursor
+
+    def _fetch(self, after):
+        body = dict(self._query)
+        if after is not None:
+            body['search_after'] = after
+        self._next_page = asyncio.ensure_future(
+            self._client.search(self._index, self._doc_type, body,
+                                **self._kwargs),
+            loop=self._loop)
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._started:
+            self._started = True
+            self._fetch(self._cursor)
+        while not self._hits:
+            if self._finished:
+                raise StopAsyncIteration
+            if self._next_page is None:
+                self._fetch(self._cursor)
+            page, self._next_page = self._next_page, None
+            resp = yield from page
+            hits = resp['hits']['hits']
+            if len(hits) < self._size:
+                # short page is the last one
+                self._finished = True
+            elif self._prefetch:
+                # request the next page while this one is consumed
+                self._fetch(hits[-1]['sort'])
+            self._hits.extend(hits)
+        hit = self._hits.popleft()
+        self._cursor = hit['sort']
+        return hit
+
+    @asyncio.coroutine
+    def close(self):
+        """Stop iteration and drop the prefetched page."""
+        self._finished = True
+        self._hits.clear()
+        if self._next_page is not None:
+            _consume(self._next_page)
+            self._next_page = None
+
+
+def search_after(client, index=None, query=None, *, doc_type=None,
+                 sort=None, tiebreaker='_uid', size=1000, cursor=None,
+                 prefetch=True, loop=None, **kwargs):
+    """
+    Deep pagination over all hits of ``query`` with ``search_after``.
+
+    Unlike :func:`scan` no search context is kept on the server and unlike
+    ``from``/``size`` paging the cost of a page doesn't grow with depth.
+    The next page is requested as soon as the current one arrives.
+
+    The iterator ``cursor`` attribute holds sort values of the last
+    returned hit; pass it back as ``cursor`` to resume an interrupted
+    export exactly after that hit.
+
+    :arg client: instance of :class:`~aioes.Elasticsearch` to use
+    :arg index: index (or list of indices) to search
+    :arg query: body for the :meth:`~aioes.Elasticsearch.search` api
+    :arg doc_type: document type to restrict the search to
+    :arg sort: sort definition, used when ``query`` has no ``sort``
+    :arg tiebreaker: unique field appended to sort (ascending) when
+        missing to make the order stable, ``_uid`` by default (use
+        ``_id`` for Elasticsearch 6.0+)
+    :arg size: number of hits per page
+    :arg cursor: sort values to continue after
+    :arg prefetch: request the next page in background while the current
+        one is consumed
+
+    Any additional keyword arguments will be passed to
+    :meth:`~aioes.Elasticsearch.search` calls.
+    """
+    return _SearchAfter(client, index=index, doc_type=doc_type, query=query,
+                        sort=sort, tiebreaker=tiebreaker, size=size,
+                        cursor=cursor, prefetch=prefetch, loop=loop,
+                        kwargs=kwargs)
+
+
+class _ReindexActions(_AsyncIterator):
+    """Turn hits of the source index into actions for the target one."""
+
+    def __init__(self, hits, index, transform):
+        self._hits = hits
+        self._index = index
+        self._transform = transform
+
+    @asyncio.coroutine
+    def __anext__(self):
+        while True:
+            hit = yield from _await(self._hits.__anext__())
+            hit['_index'] = self._index
+            if 'fields' in hit:
+                # _parent and _routing are returned as fields
+                hit.update(hit.pop('fields'))
+            if self._transform is not None:
+                hit = self._transform(hit)
+                if hit is None:
+                    # document is filtered out by transform
+                    continue
+            return hit
+
+
+@asyncio.coroutine
+def reindex(client, source_index, target_index, query=None, *,
+            target_client=None, transform=None, chunk_size=500,
+            concurrency=4, scroll='5m', progress=None,
+            scan_kwargs=None, bulk_kwargs=None, loop=None):
+    """
+    Reindex all documents from one index that satisfy a given query
+    to another, potentially (if ``target_client`` is specified) on a
+    different cluster.
+
+    Documents are read with :func:`scan` and written with
+    :func:`parallel_bulk`, so only the current scroll page and a few
+    chunks are held in memory at once.
+
+    Returns :class:`BulkStats` of the operation. Indexing errors are
+    raised as ``BulkIndexError`` unless ``raise_on_error=False`` is passed
+    in ``bulk_kwargs``.
+
+    :arg client: instance of :class:`~aioes.Elasticsearch` to use (for
+        read if ``target_client`` is specified as well)
+    :arg source_index: index (or list of indices) to read documents from
+    :arg target_index: name of the index in the target cluster to populate
+    :arg query: body for the :meth:`~aioes.Elasticsearch.search` api
+    :arg target_client: optional, is specified will be used for writing
+        (thus enabling reindex between clusters)
+    :arg transform: optional callable applied to every hit before
+        indexing, returns the (modified) hit or ``None`` to skip it
+    :arg chunk_size: number of docs in one chunk sent to es (default: 500)
+    :arg concurrency: number of bulk requests in flight at once, see
+        :func:`parallel_bulk`
+    :arg scroll: Specify how long a consistent view of the index should be
+        maintained for scrolled search
+    :arg progress: optional callable receiving :class:`BulkStats` after
+        every chunk of results
+    :arg scan_kwargs: additional kwargs to be passed to :func:`scan`
+    :arg bulk_kwargs: additional kwargs to be passed to
+        :func:`parallel_bulk`
+    """
+    target_client = client if target_client is None else target_client
+    hits = scan(client, source_index, query, scroll=scroll, loop=loop,
+                **(scan_kwargs or {}))
+    results = parallel_bulk(
+        target_client, _ReindexActions(hits, target_index, transform),
+        chunk_size=chunk_size, concurrency=concurrency,
+        loop=loop, **(bulk_kwargs or {}))
+    try:
+        done = 0
+        while True:
+            try:
+                yield from results.__anext__()
+            except StopAsyncIteration:
+                break
+            done += 1
+            if progress is not None and done % chunk_size == 0:
+                progress(results.stats)
+    finally:
+        yield from results.close()
+        yield from hits.close()
+    if progress is not None:
+        progress(results.stats)
+    return results.stats
@@ -1,8 +1,12 @@
 import abc
 import asyncio
 import collections
+import heapq
+import itertools
+import math
 import random
 import time
+import weakref
 
 from .log import logger
 
@@ -13,6 +17,10 @@ class AbstractSelector(metaclass=abc.ABCMeta):
     def select(self, connections):
         pass  # pragma: no cover
 
+    def observe(self, connection, elapsed):
+        """Feedback on request performed by *connection* in *elapsed*
+        seconds, does nothing by default."""
+
 
 class RandomSelector(AbstractSelector):
     random = random
@@ -36,32 +44,441 @@ class RoundRobinSelector(AbstractSelector):
         return connections[self._current]
 
 
+class LeastConnectionsSelector(AbstractSelector):
+    """Choose connection with the least number of in-flight requests.
+
+    Scanning starts from a rotating offset so ties are resolved in round
+    robin fashion.
+    """
+
+    def __init__(self):
+        self._current = 0
+
+    def select(self, connections):
+        count = len(connections)
+        self._current = (self._current + 1) % count
+        best = None
+        for i in range(self._current, self._current + count):
+            connection = connections[i % count]
+            if best is None or connection.in_flight < best.in_flight:
+                best = connection
+                if not best.in_flight:
+                    break
+        return best
+
+
+class EWMASelector(AbstractSelector):
+    """Prefer connections with lower exponentially weighted moving
+    average of response time.
+
+    Two random connections are compared on each pick (power of two
+    choices). Connections without observations are preferred to get
+    measured. The average decays toward zero with time constant *decay*
+    seconds since the last observation, so a node which was slow once
+    gets traffic again to refresh its statistics.
+    """
+    random = random
+    clock = time.monotonic
+
+    def __init__(self, alpha=0.3, seed=None, *, decay=10):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha should be in (0, 1] range")
+        if decay <= 0:
+            raise ValueError("decay should be positive")
+        self._alpha = alpha
+        self._decay = decay
+        # connection -> (average, time of the last observation)
+        self._ewma = weakref.WeakKeyDictionary()
+        if seed is not None:
+            self.random = random.Random(seed)
+
+    @property
+    def alpha(self):
+        return self._alpha
+
+    @property
+    def decay(self):
+        return self._decay
+
+    def ewma(self, connection):
+        """Average response time of *connection*, ``None`` if unknown."""
+        entry = self._ewma.get(connection)
+        if entry is None:
+            return None
+        return self._decayed(entry, self.clock())
+
+    def _decayed(self, entry, now):
+        value, observed_at = entry
+        return value * math.exp((observed_at - now) / self._decay)
+
+    def observe(self, connection, elapsed):
+        now = self.clock()
+        entry = self._ewma.get(connection)
+        if entry is None:
+            value = elapsed
+        else:
+            prev = self._decayed(entry, now)
+            value = prev + self._alpha * (elapsed - prev)
+        self._ewma[connection] = (value, now)
+
+    def select(self, connections):
+        if len(connections) == 1:
+            return connections[0]
+        c1, c2 = self.random.sample(connections, 2)
+        now = self.clock()
+        e1 = self._ewma.get(c1)
+        e2 = self._ewma.get(c2)
+        if e1 is None:
+            return c1
+        if e2 is None:
+            return c2
+        if self._decayed(e1, now) <= self._decayed(e2, now):
+            return c1
+        return c2
+
+
+class CircuitBreaker:
+    """Per connection circuit breaker.
+
+    Outcomes of the last *window* requests are tracked, a request is
+    failed if it ended with server side error or took more than
+    *latency_threshold* seconds. When at least *min_requests* are
+    tracked and share of failed ones reaches *error_threshold* the
+    breaker opens and the connection gets no traffic for
+    *reset_timeout* seconds. Then the breaker is half-open: up to
+    *half_open_requests* probe requests are let through, it closes if
+    all of them succeed and opens again on the first failure.
+
+    Every :meth:`acquire` should be paired with :meth:`release` when the
+    request is over, whether its outcome was recorded or not.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, *, window=50, min_requests=10, error_threshold=0.5,
+                 latency_threshold=None, reset_timeout=30,
+                 half_open_requests=3):
+        self._outcomes = collections.deque(maxlen=window)
+        self._failures = 0
+        self._min_requests = min_requests
+        self._error_threshold = error_threshold
+        self._latency_threshold = latency_threshold
+        self._reset_timeout = reset_timeout
+        self._half_open_requests = half_open_requests
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._probes = 0
+        self._probe_successes = 0
+
+    def __repr__(self):
+        return '<CircuitBreaker {}>'.format(self.state)
+
+    @property
+    def state(self):
+        if (self._state == self.OPEN and
+                time.monotonic() - self._opened_at >= self._reset_timeout):
+            self._state = self.HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+        return self._state
+
+    def available(self):
+        """Return ``True`` if the connection may get a request."""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        return self._probes < self._half_open_requests
+
+    @property
+    def reset_at(self):
+        """Time (:func:`time.monotonic`) the open breaker becomes
+        half-open, ``None`` if it is not open."""
+        if self._state != self.OPEN:
+            return None
+        return self._opened_at + self._reset_timeout
+
+    def acquire(self):
+        """Account a request sent through the connection.
+
+        Return ``True`` if the request took a half-open probe slot.
+        """
+        if self.state == self.HALF_OPEN:
+            self._probes += 1
+            return True
+        return False
+
+    def release(self):
+        """Give back probe slot of a finished request."""
+        if self._state == self.HALF_OPEN and self._probes:
+            self._probes -= 1
+
+    def record(self, failed, elapsed=None):
+        """Account outcome of a request."""
+        if (not failed and elapsed is not None and
+                self._latency_threshold is not None and
+                elapsed > self._latency_threshold):
+            failed = True
+        state = self.state
+        if state == self.OPEN:
+            # late response of request sent before tripping
+            return
+        if state == self.HALF_OPEN:
+            if failed:
+                self._open()
+            else:
+                self._probe_successes += 1
+                if self._probe_successes >= self._half_open_requests:
+                    self._close()
+            return
+        outcomes = self._outcomes
+        if len(outcomes) == outcomes.maxlen:
+            self._failures -= outcomes[0]
+        outcomes.append(failed)
+        self._failures += failed
+        if (len(outcomes) >= self._min_requests and
+                self._failures >= self._error_threshold * len(outcomes)):
+            self._open()
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._failures = 0
+
+    def _close(self):
+        self._state = self.CLOSED
+        self._outcomes.clear()
+        self._failures = 0
+
+
 class ConnectionPool:
     def __init__(self, connections, *, dead_timeout=60, timeout_cutoff=5,
                  selector_factory=RoundRobinSelector,
-                 loop):
+                 health_check_interval=None, health_check_timeout=1,
+                 circuit_breaker_factory=None, loop):
         self._dead_timeout = dead_timeout
         self._timeout_cutoff = timeout_cutoff
         self._selector = selector_factory()
-        self._dead = asyncio.PriorityQueue(len(connections), loop=loop)
         self._dead_count = collections.Counter()
-        self._connections = connections
+        # live connections and their positions for O(1) removal
+        self._connections = list(connections)
+        self._live = {c: i for i, c in enumerate(self._connections)}
+        # live connections which circuit breaker lets requests through
+        self._available = list(connections)
+        self._available_index = dict(self._live)
+        # heap of [deadline, seq, connection] entries of dead connections,
+        # connection is None in entries of removed ones
+        self._dead = []
+        self._dead_entries = {}
+        self._seq = itertools.count()
+        # dead connections taken off the heap by running health check
+        self._probing = set()
+        # both live and dead connections
+        self._all = set(connections)
         self._loop = loop
+        self._circuit_breaker_factory = circuit_breaker_factory
+        self._breakers = {}
+        # connections with not closed circuit breaker
+        self._tripped = set()
+        # heap of (reset_at, seq, connection) of open circuit breakers
+        self._reopen = []
+        self._reopen_at = {}
+        if circuit_breaker_factory is not None:
+            for connection in connections:
+                self._breakers[connection] = circuit_breaker_factory()
+        self._health_check_interval = health_check_interval
+        self._health_check_timeout = health_check_timeout
+        self._health_checker = None
+        if health_check_interval:
+            self._health_checker = asyncio.ensure_future(
+                self._health_check_loop(), loop=loop)
 
     def close(self):
-        for connection in self._connections:
+        if self._health_checker is not None:
+            self._health_checker.cancel()
+            self._health_checker = None
+        for connection in self._all:
             connection.close()
         ret = asyncio.Future(loop=self._loop)
         ret.set_result(None)
         return ret
 
     def detach(self, connection):
-        self._connections.remove(connection)
+        self.remove(connection)
+
+    def add(self, connection):
+        """
+        Add a new connection to the live pool.
+
+        :arg connection: the connection to add
+        """
+        if connection in self._all:
+            return
+        self._all.add(connection)
+        if self._circuit_breaker_factory is not None:
+            self._breakers[connection] = self._circuit_breaker_factory()
+        self._add_live(connection)
+
+    def remove(self, connection):
+        """
+        Remove a live or dead connection from the pool, forgetting its
+        failure history. The connection is not closed.
+
+        :arg connection: the connection to remove
+        """
+        if connection not in self._all:
+            return
+        self._all.remove(connection)
+        del self._dead_count[connection]
+        self._breakers.pop(connection, None)
+        self._tripped.discard(connection)
+        self._reopen_at.pop(connection, None)
+        self._probing.discard(connection)
+        if connection in self._live:
+            self._remove_live(connection)
+        else:
+            entry = self._dead_entries.pop(connection, None)
+            if entry is not None:
+                # lazy deletion, heap is cleaned up on access
+                entry[2] = None
+
+    def _add_live(self, connection):
+        self._live[connection] = len(self._connections)
+        self._connections.append(connection)
+        self._refresh(connection)
+
+    def _remove_live(self, connection):
+        # swap with the last connection to avoid shifting the list
+        index = self._live.pop(connection)
+        last = self._connections.pop()
+        if last is not connection:
+            self._connections[index] = last
+            self._live[last] = index
+        self._remove_available(connection)
+
+    def _add_available(self, connection):
+        if connection in self._available_index:
+            return
+        self._available_index[connection] = len(self._available)
+        self._available.append(connection)
+
+    def _remove_available(self, connection):
+        index = self._available_index.pop(connection, None)
+        if index is None:
+            return
+        last = self._available.pop()
+        if last is not connection:
+            self._available[index] = last
+            self._available_index[last] = index
+
+    def _refresh(self, connection):
+        """Update availability of live connection after change of its
+        circuit breaker."""
+        if connection not in self._live:
+            return
+        breaker = self._breakers.get(connection)
+        if breaker is None or breaker.available():
+            self._add_available(connection)
+            return
+        self._remove_available(connection)
+        reset_at = breaker.reset_at
+        if (reset_at is not None and
+                self._reopen_at.get(connection) != reset_at):
+            # recheck when the breaker becomes half-open
+            self._reopen_at[connection] = reset_at
+            heapq.heappush(self._reopen,
+                           (reset_at, next(self._seq), connection))
+
+    def _reset_due(self):
+        now = time.monotonic()
+        reopen = self._reopen
+        while reopen and reopen[0][0] <= now:
+            reset_at, _, connection = heapq.heappop(reopen)
+            if self._reopen_at.get(connection) == reset_at:
+                del self._reopen_at[connection]
+            self._refresh(connection)
+
+    def _peek_dead(self):
+        dead = self._dead
+        while dead and dead[0][2] is None:
+            heapq.heappop(dead)
+        return dead[0] if dead else None
+
+    def _pop_dead(self):
+        _, _, connection = heapq.heappop(self._dead)
+        del self._dead_entries[connection]
+        return connection
 
     @property
     def connections(self):
         return list(self._connections)
 
+    @property
+    def all_connections(self):
+        """Both live and dead connections."""
+        return list(self._all)
+
+    @property
+    def selector(self):
+        return self._selector
+
+    def circuit_breaker(self, connection):
+        """Return circuit breaker of the connection or ``None``."""
+        return self._breakers.get(connection)
+
+    def observe(self, connection, elapsed):
+        """
+        Pass response time of a successful request to the selector and
+        the circuit breaker.
+
+        :arg connection: the connection used
+        :arg elapsed: request duration in seconds
+        """
+        self._selector.observe(connection, elapsed)
+        self._record(connection, False, elapsed)
+
+    def observe_failure(self, connection):
+        """
+        Account a failed request in the circuit breaker.
+
+        :arg connection: the connection used
+        """
+        self._record(connection, True)
+
+    def _record(self, connection, failed, elapsed=None):
+        breaker = self._breakers.get(connection)
+        if breaker is None:
+            return
+        breaker.record(failed, elapsed)
+        if breaker.state == CircuitBreaker.CLOSED:
+            self._tripped.discard(connection)
+        else:
+            if connection not in self._tripped:
+                logger.warning('Circuit breaker of connection %r is open.',
+                               connection)
+            self._tripped.add(connection)
+        self._refresh(connection)
+
+    def release(self, connection):
+        """
+        Account the end of request sent through connection returned by
+        :meth:`get_connection`, giving back its circuit breaker probe slot.
+
+        :arg connection: the connection used
+        """
+        breaker = self._breakers.get(connection)
+        if breaker is not None:
+            breaker.release()
+            self._refresh(connection)
+
+    @property
+    def health_check_interval(self):
+        return self._health_check_interval
+
     @property
     def dead_timeout(self):
         return self._dead_timeout
@@ -78,23 +495,28 @@ class ConnectionPool:
 
         :arg connection: the failed instance
         """
-        now = time.monotonic()
         try:
-            self._connections.remove(connection)
-        except ValueError:
+            self._remove_live(connection)
+        except KeyError:
             # connection not alive or another thread marked it already, ignore
             return
         else:
-            self._dead_count[connection] += 1
-            dead_count = self._dead_count[connection]
-            timeout = self._dead_timeout * 2 ** min(dead_count - 1,
-                                                    self._timeout_cutoff)
-            yield from self._dead.put((now + timeout, connection))
-            logger.warning(
-                "Connection %r has failed for %i times in a row, "
-                "putting on %i second timeout.",
-                connection, dead_count, timeout
-            )
+            self._put_dead(connection)
+
+    def _put_dead(self, connection):
+        now = time.monotonic()
+        self._dead_count[connection] += 1
+        dead_count = self._dead_count[connection]
+        timeout = self._dead_timeout * 2 ** min(dead_count - 1,
+                                                self._timeout_cutoff)
+        entry = [now + timeout, next(self._seq), connection]
+        heapq.heappush(self._dead, entry)
+        self._dead_entries[connection] = entry
+        logger.warning(
+            "Connection %r has failed for %i times in a row, "
+            "putting on %i second timeout.",
+            connection, dead_count, timeout
+        )
 
     @asyncio.coroutine
     def mark_live(self, connection):
@@ -115,22 +537,89 @@ class ConnectionPool:
 
         :arg force: resurrect a connection even if there is none eligible (used
             when we have no live connections)
+
+        If health checks are enabled only forced resurrection is done here,
+        eligible connections are returned by the health checker.
         """
-        if self._dead.empty():
+        entry = self._peek_dead()
+        if entry is None:
+            if force and self._probing:
+                # all dead connections are being probed, don't wait for it
+                connection = self._probing.pop()
+                self._add_live(connection)
+                logger.info('Resurrecting connection %r being probed '
+                            '(force=True).', connection)
             return
 
-        timeout, connection = self._dead.get_nowait()
-
-        if not force and timeout > time.monotonic():
-            # return it back if not eligible and not forced
-            yield from self._dead.put((timeout, connection))
-            return
+        if not force:
+            if self._health_check_interval or entry[0] > time.monotonic():
+                return
 
         # either we were forced or the connection is elligible to be retried
-        self._connections.append(connection)
+        connection = self._pop_dead()
+        self._add_live(connection)
         logger.info('Resurrecting connection %r (force=%s).',
                     connection, force)
 
+    @asyncio.coroutine
+    def _health_check_loop(self):
+        while True:
+            yield from asyncio.sleep(self._health_check_interval,
+                                     loop=self._loop)
+            try:
+                yield from self.health_check()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Health check failed')
+
+    @asyncio.coroutine
+    def health_check(self):
+        """
+        Probe dead connections which timeout is over with ``HEAD /``
+        request. Connections responding successfully are returned to the
+        live pool, others are put on a longer timeout.
+        """
+        now = time.monotonic()
+        due = []
+        while True:
+            entry = self._peek_dead()
+            if entry is None or entry[0] > now:
+                break
+            due.append(self._pop_dead())
+        if not due:
+            return
+
+        self._probing.update(due)
+        try:
+            results = yield from asyncio.gather(
+                *[self._probe(connection) for connection in due],
+                loop=self._loop)
+        finally:
+            self._probing.difference_update(due)
+        for connection, ok in zip(due, results):
+            if connection not in self._all or connection in self._live:
+                # removed or resurrected by force while probing
+                continue
+            if ok:
+                self._add_live(connection)
+                logger.info('Connection %r passed health check, '
+                            'resurrecting.', connection)
+            else:
+                self._put_dead(connection)
+
+    @asyncio.coroutine
+    def _probe(self, connection):
+        try:
+            yield from asyncio.wait_for(
+                connection.perform_request('HEAD', '/', None, None),
+                self._health_check_timeout, loop=self._loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return False
+        return True
+
     @asyncio.coroutine
     def get_connection(self):
         """
@@ -141,14 +630,25 @@ class ConnectionPool:
         no connections are availible and passes the list of live connections to
         the selector instance to choose from.
 
-        Returns a connection instance
+        Returns a connection instance, it should be passed to :meth:`release`
+        when the request is over.
         """
-        yield from self.resurrect()
+        if self._dead:
+            yield from self.resurrect()
 
         # no live nodes, resurrect one by force
         if not self._connections:
             yield from self.resurrect(True)
 
-        connection = self._selector.select(self._connections)
+        if self._reopen and self._reopen[0][0] <= time.monotonic():
+            self._reset_due()
+
+        # drain connections with open circuit breaker unless all of them
+        # are drained
+        connections = self._available or self._connections
+        connection = self._selector.select(connections)
+        breaker = self._breakers.get(connection)
+        if breaker is not None and breaker.acquire():
+            self._refresh(connection)
 
         return connection
@@ -0,0 +1,216 @@
+import asyncio
+import collections
+import math
+import random
+import time
+
+import aiohttp
+
+from .exception import ConnectionError, TransportError
+
+__all__ = ('RetryPolicy', 'RetryBudget', 'HedgePolicy', 'backoff')
+
+
+# failures to establish connection, the request was not sent at all
+_CONNECT_ERRORS = (getattr(aiohttp, 'ClientConnectorError',
+                           aiohttp.ClientOSError),)
+
+
+def backoff(attempt, initial_backoff, max_backoff):
+    """Delay before retry number *attempt* (starting from 1).
+
+    Exponential backoff with full jitter, so clients failed at the same
+    moment don't retry synchronously.
+    """
+    delay = min(max_backoff, initial_backoff * 2 ** (attempt - 1))
+    return random.uniform(0, delay)
+
+
+class RetryPolicy:
+    """Rules for retrying failed requests by transport.
+
+    Connection errors, responses with status from *retry_on_status* and
+    (if *retry_on_timeout* is set) timeouts are retried up to
+    *max_retries* times with jittered exponential backoff.
+
+    Only idempotent requests are retried, except connection errors
+    happened before the request was sent.
+    """
+
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE',
+                                    'OPTIONS'])
+    # read only APIs accepting POST for passing the body
+    IDEMPOTENT_POST = frozenset(['_search', '_count', '_mget', '_msearch',
+                                 '_mpercolate', '_percolate', '_explain',
+                                 '_termvector', '_mtermvectors',
+                                 '_field_stats', '_suggest'])
+
+    def __init__(self, max_retries=3, *, initial_backoff=0.1, max_backoff=5,
+                 retry_on_status=(502, 503, 504), retry_on_timeout=False):
+        self._max_retries = max_retries
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._retry_on_status = frozenset(retry_on_status)
+        self._retry_on_timeout = retry_on_timeout
+
+    def __repr__(self):
+        return '<RetryPolicy max_retries={}>'.format(self._max_retries)
+
+    @property
+    def max_retries(self):
+        return self._max_retries
+
+    @property
+    def retry_on_status(self):
+        return self._retry_on_status
+
+    @property
+    def retry_on_timeout(self):
+        return self._retry_on_timeout
+
+    def is_idempotent(self, method, url):
+        """Return ``True`` if request may be safely sent again."""
+        method = method.upper()
+        if method in self.IDEMPOTENT_METHODS:
+            return True
+        if method == 'POST':
+            return url.rstrip('/').rsplit('/', 1)[-1] in self.IDEMPOTENT_POST
+        return False
+
+    def is_retryable(self, method, url, exc):
+        """Return ``True`` if request failed with *exc* may be retried."""
+        if isinstance(exc, ConnectionError):
+            if isinstance(exc.info, _CONNECT_ERRORS):
+                return True
+        elif isinstance(exc, asyncio.TimeoutError):
+            if not self._retry_on_timeout:
+                return False
+        elif isinstance(exc, TransportError):
+            if exc.status_code not in self._retry_on_status:
+                return False
+        else:
+            return False
+        return self.is_idempotent(method, url)
+
+    def should_retry(self, attempt, method, url, exc):
+        """Return ``True`` if request failed on retry number *attempt*
+        (``0`` for the first try) should be sent again."""
+        if attempt >= self._max_retries:
+            return False
+        return self.is_retryable(method, url, exc)
+
+    def backoff(self, attempt):
+        """Delay in seconds before retry number *attempt* (starting
+        from 1)."""
+        return backoff(attempt, self._initial_backoff, self._max_backoff)
+
+
+class RetryBudget:
+    """Token bucket limiting retries to a share of recent requests.
+
+    Every request deposits *ratio* tokens and every retry withdraws one,
+    additionally *min_retries_per_sec* tokens are added each second to
+    allow retries on low traffic. The bucket holds at most *capacity*
+    tokens. When it is empty retries are not done, so total load is
+    amplified at most by ``1 + ratio`` during outages.
+    """
+
+    def __init__(self, ratio=0.1, *, min_retries_per_sec=10, capacity=100):
+        if ratio < 0:
+            raise ValueError("ratio should be non-negative")
+        self._ratio = ratio
+        self._min_retries_per_sec = min_retries_per_sec
+        self._capacity = capacity
+        self._tokens = min(min_retries_per_sec, capacity)
+        self._last_refill = time.monotonic()
+
+    def __repr__(self):
+        return '<RetryBudget ratio={} tokens={:.1f}>'.format(
+            self._ratio, self.tokens)
+
+    @property
+    def ratio(self):
+        return self._ratio
+
+    @property
+    def tokens(self):
+        """Number of retries currently available."""
+        self._refill()
+        return self._tokens
+
+    def _refill(self):
+        now = time.monotonic()
+        tokens = (self._tokens +
+                  (now - self._last_refill) * self._min_retries_per_sec)
+        self._tokens = min(self._capacity, tokens)
+        self._last_refill = now
+
+    def deposit(self):
+        """Account a request."""
+        self._refill()
+        self._tokens = min(self._capacity, self._tokens + self._ratio)
+
+    def withdraw(self):
+        """Return ``True`` and take one token if retry is allowed."""
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class HedgePolicy:
+    """Rules for hedging latency sensitive reads.
+
+    If no response arrives within the *percentile* of recent response
+    times (out of the last *window* ones, at least *min_delay* seconds)
+    a duplicate request is sent to another node, the first response
+    wins. Hedges are limited to *max_ratio* share of requests, no hedges
+    are done until *min_samples* response times are known.
+    """
+
+    def __init__(self, percentile=95, *, min_delay=0.01, window=1000,
+                 min_samples=20, max_ratio=0.05):
+        if not 0 < percentile <= 100:
+            raise ValueError("percentile should be in (0, 100] range")
+        self._percentile = percentile
+        self._min_delay = min_delay
+        self._samples = collections.deque(maxlen=window)
+        self._min_samples = min_samples
+        self._budget = RetryBudget(max_ratio, min_retries_per_sec=0,
+                                   capacity=max(1, max_ratio * window))
+        self._delay = None
+        self._stale = 0
+
+    def __repr__(self):
+        return '<HedgePolicy percentile={}>'.format(self._percentile)
+
+    @property
+    def percentile(self):
+        return self._percentile
+
+    def observe(self, elapsed):
+        """Account response time of a successful request."""
+        self._samples.append(elapsed)
+        self._stale += 1
+
+    def delay(self):
+        """Delay in seconds before sending a hedge, ``None`` if there are
+        not enough samples yet."""
+        if len(self._samples) < self._min_samples:
+            return None
+        # sorting is amortized by recalculating every 10 samples
+        if self._delay is None or self._stale >= 10:
+            samples = sorted(self._samples)
+            index = math.ceil(len(samples) * self._percentile / 100) - 1
+            self._delay = max(self._min_delay, samples[index])
+            self._stale = 0
+        return self._delay
+
+    def deposit(self):
+        """Account a hedgeable request."""
+        self._budget.deposit()
+
+    def allow(self):
+        """Return ``True`` and account the hedge if budget allows it."""
+        return self._budget.withdraw()
@@ -0,0 +1,141 @@
+import collections
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from .exception import SerializationError
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import rapidjson
+except ImportError:  # pragma: no cover
+    rapidjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+__all__ = ('JSONSerializer', 'OrjsonSerializer', 'UJSONSerializer',
+           'RapidJSONSerializer', 'SERIALIZERS', 'fastest_serializer')
+
+
+class JSONSerializer:
+    """Serializer based on :mod:`json` from standard library.
+
+    ``dumps()`` returns encoded ``bytes`` ready to be sent, ``loads()``
+    accepts both ``str`` and ``bytes``.
+    """
+
+    mimetype = 'application/json'
+
+    def default(self, data):
+        if isinstance(data, (date, datetime)):
+            return data.isoformat()
+        elif isinstance(data, Decimal):
+            return float(data)
+        elif isinstance(data, uuid.UUID):
+            return str(data)
+        raise TypeError("Unable to serialize {!r} (type: {})".format(
+            data, type(data)))
+
+    def _loads(self, s):
+        if isinstance(s, bytes):
+            s = s.decode('utf-8')
+        return json.loads(s)
+
+    def _dumps(self, data):
+        return json.dumps(data, default=self.default).encode('utf-8')
+
+    def loads(self, s):
+        try:
+            return self._loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        try:
+            return self._dumps(data)
+        except (ValueError, TypeError, OverflowError) as e:
+            raise SerializationError(data, e)
+
+
+class OrjsonSerializer(JSONSerializer):
+    """Serializer based on orjson_ library.
+
+    .. _orjson: https://pypi.python.org/pypi/orjson
+    """
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("orjson is not installed")
+
+    def _loads(self, s):
+        return orjson.loads(s)
+
+    def _dumps(self, data):
+        return orjson.dumps(data, default=self.default)
+
+
+class RapidJSONSerializer(JSONSerializer):
+    """Serializer based on python-rapidjson_ library.
+
+    .. _python-rapidjson: https://pypi.python.org/pypi/python-rapidjson
+    """
+
+    def __init__(self):
+        if rapidjson is None:
+            raise RuntimeError("python-rapidjson is not installed")
+
+    def _loads(self, s):
+        if isinstance(s, bytes):
+            s = s.decode('utf-8')
+        return rapidjson.loads(s)
+
+    def _dumps(self, data):
+        return rapidjson.dumps(data, default=self.default).encode('utf-8')
+
+
+class UJSONSerializer(JSONSerializer):
+    """Serializer based on ujson_ library.
+
+    ujson has no hook for custom types, data it can't handle is passed to
+    the standard :mod:`json` serializer.
+
+    .. _ujson: https://pypi.python.org/pypi/ujson
+    """
+
+    def __init__(self):
+        if ujson is None:
+            raise RuntimeError("ujson is not installed")
+
+    def _loads(self, s):
+        if isinstance(s, bytes):
+            s = s.decode('utf-8')
+        return ujson.loads(s)
+
+    def _dumps(self, data):
+        try:
+            return ujson.dumps(data, ensure_ascii=False).encode('utf-8')
+        except (TypeError, OverflowError):
+            return super()._dumps(data)
+
+
+# serializers usable in current environment, fastest first
+SERIALIZERS = collections.OrderedDict(
+    (name, cls) for name, lib, cls in (
+        ('orjson', orjson, OrjsonSerializer),
+        ('ujson', ujson, UJSONSerializer),
+        ('rapidjson', rapidjson, RapidJSONSerializer),
+        ('json', json, JSONSerializer))
+    if lib is not None)
+
+
+def fastest_serializer():
+    """Return instance of the fastest serializer available."""
+    return next(iter(SERIALIZERS.values()))()
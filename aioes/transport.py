@@ -1,17 +1,24 @@
 import asyncio
 import collections
+import gzip
+import inspect
 import itertools
-import json
 import random
 import re
 import time
 import urllib.parse
 
+import aiohttp
+
 from .connection import Connection
-from .exception import ConnectionError, TransportError
-from .pool import ConnectionPool
+from .exception import ConnectionError, SerializationError, TransportError
+from .log import logger
+from .pool import ConnectionPool, RoundRobinSelector
+from .retry import RetryPolicy
+from .serializer import JSONSerializer
 
 Endpoint = collections.namedtuple('TCPEndpoint', 'scheme host port')
+RawResponse = collections.namedtuple('RawResponse', 'headers body')
 
 
 def validate_endpoint(endpoint):
@@ -29,6 +36,20 @@ def get_default_port(scheme):
 
 DEFAULT_SCHEME = 'http'
 
+# balance between ratio and speed, JSON compresses well on low levels
+COMPRESS_LEVEL = 6
+
+# sockets per node of the default connector, same as aiohttp default
+# limit of connector used by every connection before
+CONNECTIONS_PER_NODE = 100
+
+_LIMIT_PER_HOST = (
+    'limit_per_host' in inspect.signature(aiohttp.TCPConnector).parameters)
+
+
+def _compress(body):
+    return gzip.compress(body, COMPRESS_LEVEL)
+
 
 class Transport:
     """Encapsulation of transport-related to logic.
@@ -44,27 +65,105 @@ class Transport:
     ADDRESS_RE = re.compile(
             r'(?:^|/)(?P<host>[\.:0-9a-f]*):(?P<port>[0-9]+)\]?$')
 
+    # APIs accepting server side ``timeout`` parameter set from deadline
+    SERVER_TIMEOUT_APIS = frozenset(['_search', '_bulk'])
+
     def __init__(self, endpoints, *,
                  sniffer_interval=None, sniffer_timeout=0.1, max_retries=3,
-                 loop, verify_ssl=True, connector_factory=lambda: None):
+                 loop, verify_ssl=True, connector_factory=lambda: None,
+                 serializer=None, executor=None, offload_threshold=None,
+                 http_compress=False, compress_threshold=1024,
+                 min_sniff_interval=1.0,
+                 selector_factory=RoundRobinSelector,
+                 health_check_interval=None, max_connections_per_node=None,
+                 max_pending_per_node=None, retry_policy=None,
+                 retry_budget=None, circuit_breaker_factory=None,
+                 hedge_policy=None):
         self._loop = loop
-        self._connector_factory = connector_factory
+        connector = connector_factory()
+        if connector is None:
+            kwargs = {}
+            if _LIMIT_PER_HOST:
+                # cap sockets per node, not in total
+                kwargs['limit'] = None
+                kwargs['limit_per_host'] = (max_connections_per_node or
+                                            CONNECTIONS_PER_NODE)
+            connector = aiohttp.TCPConnector(use_dns_cache=True,
+                                             verify_ssl=verify_ssl,
+                                             loop=loop,
+                                             **kwargs)
+        # single session shared by all connections keeps DNS cache, SSL
+        # contexts and keep-alive sockets across topology changes
+        self._session = aiohttp.ClientSession(connector=connector, loop=loop)
+        if serializer is None:
+            serializer = JSONSerializer()
+        self._serializer = serializer
         self._endpoints = self._convert_endpoints(endpoints)
-        self._pool = ConnectionPool([], loop=loop)
-        self._verify_ssl = verify_ssl
+        self._pool = ConnectionPool(
+            [], loop=loop, selector_factory=selector_factory,
+            health_check_interval=health_check_interval,
+            circuit_breaker_factory=circuit_breaker_factory)
+        self._max_connections_per_node = max_connections_per_node
+        self._max_pending_per_node = max_pending_per_node
+        self._seed_connections = []
         self._reinitialize_endpoints()
         self._seed_connections = list(self._pool.connections)
         self._sniffer_interval = sniffer_interval
         self._sniffer_timeout = sniffer_timeout
         self._last_sniff = time.monotonic()
-        self._max_retries = max_retries
+        self._min_sniff_interval = min_sniff_interval
+        # start time of the last sniff attempt, successful or not
+        self._last_sniff_attempt = float('-inf')
+        # in-flight sniff task shared by all waiters
+        self._sniffing = None
+        self._sniffer = None
+        if sniffer_interval:
+            self._sniffer = asyncio.ensure_future(self._sniffer_loop(),
+                                                  loop=loop)
+        if retry_policy is None:
+            retry_policy = RetryPolicy(max_retries)
+        self._retry_policy = retry_policy
+        self._retry_budget = retry_budget
+        self._hedge_policy = hedge_policy
+        self._executor = executor
+        self._offload_threshold = offload_threshold
+        self._http_compress = http_compress
+        self._compress_threshold = compress_threshold
 
     def __repr__(self):
         return '<Transport {}>'.format(self._endpoints)
 
     @property
     def max_retries(self):
-        return self._max_retries
+        return self._retry_policy.max_retries
+
+    @property
+    def retry_policy(self):
+        return self._retry_policy
+
+    @property
+    def retry_budget(self):
+        return self._retry_budget
+
+    @property
+    def hedge_policy(self):
+        return self._hedge_policy
+
+    @property
+    def serializer(self):
+        return self._serializer
+
+    @property
+    def http_compress(self):
+        return self._http_compress
+
+    @property
+    def compress_threshold(self):
+        return self._compress_threshold
+
+    @property
+    def offload_threshold(self):
+        return self._offload_threshold
 
     @property
     def last_sniff(self):
@@ -78,6 +177,10 @@ class Transport:
     def sniffer_timeout(self):
         return self._sniffer_timeout
 
+    @property
+    def min_sniff_interval(self):
+        return self._min_sniff_interval
+
     @property
     def endpoints(self):
         return list(self._endpoints)
@@ -88,7 +191,32 @@ class Transport:
         self._reinitialize_endpoints()
 
     def close(self):
-        return self._pool.close()
+        if self._sniffer is not None:
+            self._sniffer.cancel()
+            self._sniffer = None
+        if self._sniffing is not None:
+            self._sniffing.cancel()
+        for connection in self._seed_connections:
+            # seeds are kept open for sniffing after removal from pool
+            connection.close()
+        ret = self._pool.close()
+        self._session.close()
+        return ret
+
+    @asyncio.coroutine
+    def offload(self, size, func, *args):
+        """Call ``func(*args)`` in executor if *size* reaches threshold.
+
+        *size* is ``None`` if it is unknown in advance, the call is
+        offloaded whenever offloading is enabled in this case.
+        """
+        threshold = self._offload_threshold
+        if threshold is None or (size is not None and size < threshold):
+            return func(*args)
+        loop = self._loop
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        return (yield from loop.run_in_executor(self._executor, func, *args))
 
     def _convert_endpoints(self, endpoints):
         ret = []
@@ -138,22 +266,28 @@ class Transport:
         return ret
 
     def _reinitialize_endpoints(self):
-        old_connections = {c.endpoint: c for c in self._pool.connections}
+        # apply the difference keeping state of existing connections
+        old_connections = {c.endpoint: c for c in self._pool.all_connections}
+        new_endpoints = set(self._endpoints)
+        for endpoint, connection in old_connections.items():
+            if endpoint not in new_endpoints:
+                self._pool.remove(connection)
+                if connection not in self._seed_connections:
+                    # let in-flight requests finish
+                    connection.close_when_idle()
         connections = []
         for endpoint in self._endpoints:
-            if endpoint in old_connections:
-                connection = old_connections[endpoint]
-                connections.append(connection)
-                self._pool.detach(connection)
-            else:
+            if endpoint not in old_connections:
                 connections.append(Connection(
                     endpoint,
                     loop=self._loop,
-                    verify_ssl=self._verify_ssl,
-                    connector=self._connector_factory()))
-        self._pool.close()
+                    session=self._session,
+                    serializer=self._serializer,
+                    max_connections=self._max_connections_per_node,
+                    max_pending=self._max_pending_per_node))
         random.shuffle(connections)
-        self._pool = ConnectionPool(connections, loop=self._loop)
+        for connection in connections:
+            self._pool.add(connection)
 
     @asyncio.coroutine
     def get_connection(self):
@@ -161,12 +295,32 @@ class Transport:
         Retreive a :class:`~aioes.Connection` instance from the
         :class:`~aioes.ConnectionPool` instance.
         """
-        if self._sniffer_interval:
-            if time.monotonic() >= self._last_sniff + self._sniffer_interval:
-                yield from self.sniff_endpoints()
         ret = yield from self._pool.get_connection()
         return ret
 
+    @asyncio.coroutine
+    def _sniffer_loop(self):
+        """Sniff endpoints every `sniffer_interval` seconds in background,
+        keeping topology discovery out of the request path.
+
+        """
+        while True:
+            deadline = self._last_sniff + self._sniffer_interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                yield from asyncio.sleep(delay, loop=self._loop)
+                continue
+            try:
+                yield from self.sniff_endpoints()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning('Sniffing failed: %s', exc)
+                # last_sniff is not updated on failure, wait before
+                # the next attempt
+                yield from asyncio.sleep(self._sniffer_interval,
+                                         loop=self._loop)
+
     @asyncio.coroutine
     def sniff_endpoints(self):
         """Obtain a list of nodes from the cluster and create a new connection
@@ -175,7 +329,30 @@ class Transport:
         To extract the node connection parameters use the
         `nodes_to_endpoint_callback`.
 
+        Concurrent calls share the single in-flight sniffing request,
+        cancellation of a waiter doesn't cancel the sniffing.
+
         """
+        yield from asyncio.shield(self._start_sniff(), loop=self._loop)
+
+    def _start_sniff(self):
+        """Return in-flight sniffing task, starting it if needed."""
+        if self._sniffing is None:
+            self._last_sniff_attempt = time.monotonic()
+            self._sniffing = asyncio.ensure_future(self._sniff(),
+                                                   loop=self._loop)
+            self._sniffing.add_done_callback(self._sniff_done)
+        return self._sniffing
+
+    def _sniff_done(self, fut):
+        self._sniffing = None
+        if not fut.cancelled():
+            # mark exception as retrieved, waiters (if any) get it
+            # from the shield
+            fut.exception()
+
+    @asyncio.coroutine
+    def _sniff(self):
         previous_sniff = self._last_sniff
         try:
             # reset last_sniff timestamp
@@ -198,8 +375,8 @@ class Transport:
                 except ConnectionError:
                     continue
                 try:
-                    node_info = json.loads(node_info)
-                except (TypeError, ValueError):
+                    node_info = self._serializer.loads(node_info)
+                except SerializationError:
                     continue
                 break
             else:
@@ -243,29 +420,135 @@ class Transport:
         self.endpoints = endpoints
 
     @asyncio.coroutine
-    def _mark_dead(self, connection):
+    def _mark_dead(self, connection, *, wait=True):
         """
         Mark a connection as dead (failed) in the connection pool. If sniffing
         on failure is enabled this will initiate the sniffing process.
 
+        Sniffing is started at most once per `min_sniff_interval`,
+        failures happening during the in-flight sniff wait for it.
+
         :arg connection: instance of :class:`~aioes.Connection` that failed
+        :arg wait: wait for the sniffing, otherwise it's done in background
         """
         # mark as dead even when sniffing to avoid hitting this endpoint
         # during the sniff process
 
         yield from self._pool.mark_dead(connection)
-        yield from self.sniff_endpoints()
+        if self._sniffing is None:
+            since = time.monotonic() - self._last_sniff_attempt
+            if since < self._min_sniff_interval:
+                return
+        sniffing = self._start_sniff()
+        if wait:
+            yield from asyncio.shield(sniffing, loop=self._loop)
+
+    def _observe_error(self, connection, exc, elapsed):
+        if isinstance(exc, TransportError):
+            status = exc.status_code
+            if not isinstance(status, int):
+                # not a response, e.g. full request queue
+                return
+            if status < 500:
+                # the node is healthy, request is bad
+                self._pool.observe(connection, elapsed)
+                return
+        self._pool.observe_failure(connection)
+
+    @asyncio.coroutine
+    def _hedged(self, connection, send):
+        """Send request and its hedge if the response is late.
+
+        Return connection, future and start time of the first successful
+        request, or of the last failed one if all of them failed.
+        """
+        policy = self._hedge_policy
+        primary = asyncio.ensure_future(send(connection), loop=self._loop)
+        legs = {primary: (connection, time.monotonic())}
+        other = None
+        try:
+            delay = policy.delay()
+            if delay is not None:
+                yield from asyncio.wait([primary], timeout=delay,
+                                        loop=self._loop)
+                if (not primary.done() and
+                        len(self._pool.connections) > 1 and
+                        policy.allow()):
+                    for i in range(2):
+                        other = yield from self.get_connection()
+                        if other is not connection:
+                            break
+                        self._pool.release(other)
+                        other = None
+                    if other is not None:
+                        other.dispatch()
+                        hedge = asyncio.ensure_future(send(other),
+                                                      loop=self._loop)
+                        legs[hedge] = (other, time.monotonic())
+
+            while True:
+                done, _ = yield from asyncio.wait(
+                    list(legs), loop=self._loop,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    leg_connection, started = legs.pop(fut)
+                    exc = fut.exception()
+                    if exc is None or not legs:
+                        return leg_connection, fut, started
+                    # another leg is still running, account the failure
+                    if isinstance(exc, ConnectionError):
+                        self._pool.observe_failure(leg_connection)
+                        # don't delay the other leg by sniffing
+                        yield from self._mark_dead(leg_connection,
+                                                   wait=False)
+                    elif isinstance(exc, TransportError):
+                        self._observe_error(leg_connection, exc,
+                                            time.monotonic() - started)
+                    else:
+                        raise exc
+        finally:
+            for fut in legs:
+                if fut.done():
+                    if not fut.cancelled():
+                        fut.exception()
+                else:
+                    # the loser
+                    fut.cancel()
+            if other is not None:
+                other.finish()
+                self._pool.release(other)
+
+    @asyncio.coroutine
+    def _within(self, coro, deadline):
+        """Wait for *coro* until absolute *deadline* if it's given."""
+        if deadline is None:
+            return (yield from coro)
+        return (yield from asyncio.wait_for(
+            coro, deadline - time.monotonic(), loop=self._loop))
+
+    def _should_retry(self, attempt, method, url, exc, deadline=None):
+        if not self._retry_policy.should_retry(attempt, method, url, exc):
+            return False
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        budget = self._retry_budget
+        if budget is not None and not budget.withdraw():
+            logger.warning('Retry budget is exhausted, not retrying %s %s',
+                           method, url)
+            return False
+        return True
 
     @asyncio.coroutine
     def perform_request(self, method, url, params=None, body=None,
-                        *, request_timeout=None, decoder=json.loads):
+                        *, request_timeout=None, decoder=None, raw=False,
+                        hedge=False, deadline=None):
         """
         Perform the actual request. Retrieve a connection from the connection
         pool, pass all the information to it's perform_request method and
         return the data.
 
-        If an exception was raised, mark the connection as failed and retry (up
-        to `max_retries` times).
+        If a connection error was raised, mark the connection as failed.
+        Failed requests are retried according to `retry_policy`.
 
         If the operation was succesful and the connection used was previously
         marked as dead, mark it as live, resetting it's failure count.
@@ -276,14 +559,30 @@ class Transport:
           underlying :class:`~elasticsearch.Connection` class for serialization
         :arg body: body of the request, will be serializes using serializer and
             passed to the connection
+        :arg decoder: callable for decoding the response body, ``loads()``
+            of the transport serializer by default
+        :arg raw: return :class:`RawResponse` with response headers and
+            undecoded ``bytes`` body instead of parsed data
+        :arg hedge: send duplicate of idempotent request to another node
+            if the response is late, according to `hedge_policy`
+        :arg deadline: absolute :func:`time.monotonic` time limiting the
+            call including all retries, server side ``timeout`` parameter
+            of search and bulk requests is derived from it
         """
         if body is not None:
             if not isinstance(body, (str, bytes)):
-                body = json.dumps(body)
+                body = self._serializer.dumps(body)
 
             if not isinstance(body, bytes):
                 body = body.encode('utf-8')
 
+        req_headers = None
+        if self._http_compress:
+            req_headers = {'Accept-Encoding': 'gzip,deflate'}
+            if body is not None and len(body) >= self._compress_threshold:
+                body = yield from self.offload(len(body), _compress, body)
+                req_headers['Content-Encoding'] = 'gzip'
+
         if params is not None:
             to_replace = {}
             for k, v in params.items():
@@ -292,27 +591,115 @@ class Transport:
             for k, v in to_replace.items():
                 params[k] = v
 
-        for attempt in range(self.max_retries + 1):
-            connection = yield from self.get_connection()
+        def send(connection):
+            return connection.perform_request(
+                method,
+                url,
+                params,
+                body,
+                headers=req_headers,
+                raw=raw)
+
+        hedge_policy = self._hedge_policy
+        if hedge and hedge_policy is not None:
+            hedge = self._retry_policy.is_idempotent(method, url)
+        else:
+            hedge = False
+        if hedge:
+            hedge_policy.deposit()
+
+        server_timeout = False
+        if deadline is not None:
+            api = url.rstrip('/').rsplit('/', 1)[-1]
+            if api in self.SERVER_TIMEOUT_APIS:
+                if params is None:
+                    params = {}
+                server_timeout = 'timeout' not in params
+
+        if self._retry_budget is not None:
+            self._retry_budget.deposit()
+        attempt = 0
+        error = None
+        while True:
+            timeout = request_timeout
+            cut = False
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if error is not None:
+                        # backoff delay overslept the deadline
+                        raise error
+                    raise asyncio.TimeoutError()
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+                    cut = True
+                if server_timeout:
+                    params['timeout'] = '{}ms'.format(
+                        int(remaining * 1000) or 1)
+
+            connection = yield from self._within(self.get_connection(),
+                                                 deadline)
+            # hedged request may rebind connection to the winning one
+            acquired = connection
+            acquired.dispatch()
 
             try:
-                status, headers, data = yield from asyncio.wait_for(
-                    connection.perform_request(
-                        method,
-                        url,
-                        params,
-                        body),
-                    request_timeout,
-                    loop=self._loop)
-            except ConnectionError:
-                yield from self._mark_dead(connection)
-
-                # raise exception on last retry
-                if attempt == self.max_retries:
+                started = time.monotonic()
+                if hedge:
+                    # latency is measured from the start of the winner
+                    connection, fut, started = yield from asyncio.wait_for(
+                        self._hedged(connection, send),
+                        timeout,
+                        loop=self._loop)
+                    status, headers, data = fut.result()
+                else:
+                    status, headers, data = yield from asyncio.wait_for(
+                        send(connection),
+                        timeout,
+                        loop=self._loop)
+            except ConnectionError as exc:
+                self._pool.observe_failure(connection)
+                try:
+                    yield from self._within(self._mark_dead(connection),
+                                            deadline)
+                except asyncio.TimeoutError:
+                    # sniffing goes on, the deadline is over
+                    pass
+                if not self._should_retry(attempt, method, url, exc,
+                                          deadline):
+                    raise
+                error = exc
+            except (asyncio.TimeoutError, TransportError) as exc:
+                if not (cut and isinstance(exc, asyncio.TimeoutError)):
+                    # don't blame the node for short caller's deadline
+                    self._observe_error(connection, exc,
+                                        time.monotonic() - started)
+                if not self._should_retry(attempt, method, url, exc,
+                                          deadline):
                     raise
+                error = exc
             else:
                 # connection didn't fail, confirm it's live status
+                elapsed = time.monotonic() - started
+                self._pool.observe(connection, elapsed)
+                if hedge:
+                    hedge_policy.observe(elapsed)
                 yield from self._pool.mark_live(connection)
+                if raw:
+                    return status, RawResponse(headers, data)
                 if data:
-                    data = decoder(data)
+                    if decoder is None:
+                        decoder = self._serializer.loads
+                    data = yield from self.offload(len(data), decoder, data)
                 return status, data
+            finally:
+                acquired.finish()
+                self._pool.release(acquired)
+
+            attempt += 1
+            delay = self._retry_policy.backoff(attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                # no time left for another attempt
+                raise error
+            if delay:
+                yield from asyncio.sleep(delay, loop=self._loop)
@@ -0,0 +1,62 @@
+"""Serializer benchmark.
+
+Measure encoding and decoding speed of serializers available in
+`aioes.serializer` on a bulk-like and a search-response-like payload.
+"""
+
+import random
+import timeit
+
+from aioes.serializer import SERIALIZERS
+
+
+def make_doc(i):
+    return {
+        'id': i,
+        'user': 'user{}'.format(i % 100),
+        'message': 'trying out Elasticsearch ' * 5,
+        'score': random.random(),
+        'tags': ['tag{}'.format(j) for j in range(10)],
+        'nested': {'a': i, 'b': [1.5, 2.5, 3.5], 'c': None, 'd': True},
+    }
+
+
+def make_search_response(size):
+    return {
+        'took': 12,
+        'timed_out': False,
+        '_shards': {'total': 5, 'successful': 5, 'failed': 0},
+        'hits': {
+            'total': size,
+            'max_score': 1.0,
+            'hits': [{'_index': 'index', '_type': 'type', '_id': str(i),
+                      '_score': 1.0, '_source': make_doc(i)}
+                     for i in range(size)],
+        },
+    }
+
+
+def bench(number=20):
+    docs = [make_doc(i) for i in range(1000)]
+    response = make_search_response(1000)
+    encoded = SERIALIZERS['json']().dumps(response)
+
+    print('-' * 70)
+    print('{:<10} {:>18} {:>18} {:>18}'.format(
+        'serializer', 'dumps 1000 docs', 'dumps response', 'loads response'))
+    for name, cls in SERIALIZERS.items():
+        s = cls()
+        t_docs = timeit.timeit(lambda: [s.dumps(d) for d in docs],
+                               number=number) / number
+        t_dumps = timeit.timeit(lambda: s.dumps(response),
+                                number=number) / number
+        t_loads = timeit.timeit(lambda: s.loads(encoded),
+                                number=number) / number
+        print('{:<10} {:>15.2f} ms {:>15.2f} ms {:>15.2f} ms'.format(
+            name, t_docs * 1000, t_dumps * 1000, t_loads * 1000))
+    print('-' * 70)
+    print('response size: {} bytes'.format(len(encoded)))
+
+
+if __name__ == '__main__':
+    bench()
@@ -1,4 +1,7 @@
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 from unittest import mock
 
@@ -1146,3 +1149,63 @@ def test__repr__(loop):
         "<Elasticsearch [<Transport ["
         "TCPEndpoint(scheme='http', host='localhost', port=9200)"
         "]>]>")
+
+
+@asyncio.coroutine
+def test_bulk_body_offload(loop):
+    threads = []
+
+    def dumps(data):
+        threads.append(threading.get_ident())
+        return b'{}'
+
+    with ThreadPoolExecutor(1) as executor:
+        cl = Elasticsearch([], loop=loop, executor=executor,
+                           offload_threshold=1024)
+        cl.transport.serializer.dumps = dumps
+        body = yield from cl._bulk_body(iter([{}, {}]))
+        assert b'{}\n{}\n' == body
+        assert 2 == len(threads)
+        assert threading.get_ident() not in threads
+
+
+@asyncio.coroutine
+def test_deadline_passed_to_transport(loop):
+    cl = Elasticsearch([], loop=loop)
+    calls = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params=None, body=None, **kwargs):
+        calls.append((url, kwargs))
+        return 200, {}
+
+    cl.transport.perform_request = perform_request
+    try:
+        yield from cl.search('index', body={}, deadline=10)
+        yield from cl.get('index', '1', deadline=11)
+        yield from cl.mget({}, 'index', deadline=12)
+        yield from cl.count('index', deadline=13)
+        yield from cl.bulk([{}], 'index', deadline=14)
+        assert [10, 11, 12, 13, 14] == [kw['deadline'] for _, kw in calls]
+        assert [True] * 4 == [kw.get('hedge') for _, kw in calls[:4]]
+    finally:
+        cl.close()
+
+
+@asyncio.coroutine
+def test_scroll_search_not_hedged(loop):
+    cl = Elasticsearch([], loop=loop)
+    calls = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params=None, body=None, **kwargs):
+        calls.append(kwargs['hedge'])
+        return 200, {}
+
+    cl.transport.perform_request = perform_request
+    try:
+        yield from cl.search('index', body={})
+        yield from cl.search('index', body={}, scroll='1m')
+        assert [True, False] == calls
+    finally:
+        cl.close()
@@ -6,8 +6,8 @@ import pytest
 
 from aioes.connection import Connection
 # 400 404 409
-from aioes.exception import (TransportError, RequestError,
-                             NotFoundError, ConflictError)
+from aioes.exception import (TransportError, RequestError, QueueFullError,
+                             ConnectionError, NotFoundError, ConflictError)
 from aioes.transport import Endpoint
 
 
@@ -119,3 +119,231 @@ def test_bad_status_409(loop):
     assert 409 == ctx.value.status_code
     assert '{"a": 1}' == ctx.value.error
     assert {"a": 1} == ctx.value.info
+
+
+@asyncio.coroutine
+def test_raw(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop)
+    resp = mock.Mock()
+    resp.status = 200
+    resp.headers = {'Content-Type': 'application/json'}
+    r2 = asyncio.Future(loop=loop)
+    r2.set_result(b'{"a": 1}')
+    resp.read.return_value = r2
+    fut = asyncio.Future(loop=loop)
+    fut.set_result(resp)
+    conn._session.request = mock.Mock(return_value=fut)
+
+    status, headers, data = yield from conn.perform_request(
+        'GET', '/data', None, None, raw=True)
+    assert 200 == status
+    assert {'Content-Type': 'application/json'} == headers
+    assert b'{"a": 1}' == data
+    assert not resp.text.called
+
+
+@asyncio.coroutine
+def test_raw_bad_status(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop)
+    resp = mock.Mock()
+    resp.status = 404
+    r2 = asyncio.Future(loop=loop)
+    r2.set_result(b'{"a": 1}')
+    resp.read.return_value = r2
+    fut = asyncio.Future(loop=loop)
+    fut.set_result(resp)
+    conn._session.request = mock.Mock(return_value=fut)
+
+    with pytest.raises(NotFoundError) as ctx:
+        yield from conn.perform_request('GET', '/data', None, None, raw=True)
+    assert 404 == ctx.value.status_code
+    assert '{"a": 1}' == ctx.value.error
+    assert {"a": 1} == ctx.value.info
+
+
+@asyncio.coroutine
+def test_headers(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop)
+    resp = mock.Mock()
+    resp.status = 200
+    resp.headers = {}
+    r2 = asyncio.Future(loop=loop)
+    r2.set_result('{}')
+    resp.text.return_value = r2
+    fut = asyncio.Future(loop=loop)
+    fut.set_result(resp)
+    conn._session.request = mock.Mock(return_value=fut)
+
+    yield from conn.perform_request('POST', '/data', None, b'body',
+                                    headers={'Content-Encoding': 'gzip'})
+    _, kwargs = conn._session.request.call_args
+    assert {'Content-Encoding': 'gzip'} == kwargs['headers']
+    assert b'body' == kwargs['data']
+
+
+@asyncio.coroutine
+def test_close_when_idle(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop)
+    resp = mock.Mock()
+    resp.status = 200
+    resp.headers = {}
+    r2 = asyncio.Future(loop=loop)
+    resp.text.return_value = r2
+    fut = asyncio.Future(loop=loop)
+    fut.set_result(resp)
+    conn._session.request = mock.Mock(return_value=fut)
+
+    conn.dispatch()
+    task = asyncio.ensure_future(
+        conn.perform_request('GET', '/data', None, None), loop=loop)
+    # counted before the request coroutine is running
+    assert 1 == conn.in_flight
+    yield from asyncio.sleep(0, loop=loop)
+    conn.close_when_idle()
+    assert not conn.closed
+
+    r2.set_result('{}')
+    yield from task
+    assert not conn.closed
+    conn.finish()
+    assert 0 == conn.in_flight
+    assert conn.closed
+    assert conn._session.closed
+
+
+def test_close_when_idle_no_requests(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop)
+    assert 0 == conn.in_flight
+    conn.close_when_idle()
+    assert conn.closed
+
+
+def _blocking_request(loop, conn):
+    started = []
+    gate = asyncio.Future(loop=loop)
+
+    @asyncio.coroutine
+    def _perform_request(method, url, params, body, **kwargs):
+        started.append(url)
+        yield from gate
+        return 200, {}, ''
+
+    conn._perform_request = _perform_request
+    return started, gate
+
+
+@asyncio.coroutine
+def test_max_connections(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop,
+                      max_connections=2)
+    assert 2 == conn.max_connections
+    assert 2 == conn._session.connector.limit
+    started, gate = _blocking_request(loop, conn)
+
+    tasks = [asyncio.ensure_future(
+        conn.perform_request('GET', '/{}'.format(i), None, None), loop=loop)
+        for i in range(5)]
+    yield from asyncio.sleep(0.01, loop=loop)
+    assert ['/0', '/1'] == started
+    assert 3 == conn.pending
+
+    gate.set_result(None)
+    yield from asyncio.gather(*tasks, loop=loop)
+    # queued requests are served in FIFO order
+    assert ['/0', '/1', '/2', '/3', '/4'] == started
+    assert 0 == conn.pending
+    assert 0 == conn._active
+    conn.close()
+
+
+@asyncio.coroutine
+def test_max_pending(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop,
+                      max_connections=1, max_pending=1)
+    assert 1 == conn.max_pending
+    started, gate = _blocking_request(loop, conn)
+
+    t1 = asyncio.ensure_future(
+        conn.perform_request('GET', '/1', None, None), loop=loop)
+    t2 = asyncio.ensure_future(
+        conn.perform_request('GET', '/2', None, None), loop=loop)
+    yield from asyncio.sleep(0.01, loop=loop)
+    with pytest.raises(QueueFullError) as ctx:
+        yield from conn.perform_request('GET', '/3', None, None)
+    assert Endpoint('http', 'host', 9999) == ctx.value.info
+
+    gate.set_result(None)
+    yield from asyncio.gather(t1, t2, loop=loop)
+    assert ['/1', '/2'] == started
+    conn.close()
+
+
+@asyncio.coroutine
+def test_max_connections_cancel_waiter(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop,
+                      max_connections=1)
+    started, gate = _blocking_request(loop, conn)
+
+    t1 = asyncio.ensure_future(
+        conn.perform_request('GET', '/1', None, None), loop=loop)
+    t2 = asyncio.ensure_future(
+        conn.perform_request('GET', '/2', None, None), loop=loop)
+    t3 = asyncio.ensure_future(
+        conn.perform_request('GET', '/3', None, None), loop=loop)
+    yield from asyncio.sleep(0.01, loop=loop)
+    t2.cancel()
+    yield from asyncio.sleep(0, loop=loop)
+    assert 1 == conn.pending
+
+    gate.set_result(None)
+    yield from asyncio.gather(t1, t3, loop=loop)
+    assert ['/1', '/3'] == started
+    assert 0 == conn._active
+    conn.close()
+
+
+@asyncio.coroutine
+def test_max_connections_cancel_waiter_on_release(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop,
+                      max_connections=1)
+    started, gate = _blocking_request(loop, conn)
+
+    tasks = [asyncio.ensure_future(
+        conn.perform_request('GET', '/{}'.format(i), None, None),
+        loop=loop) for i in (1, 2, 3)]
+    yield from asyncio.sleep(0.01, loop=loop)
+    # the slot is released while the waiter is being cancelled
+    gate.set_result(None)
+    tasks[1].cancel()
+    results = yield from asyncio.gather(*tasks, loop=loop,
+                                        return_exceptions=True)
+    assert isinstance(results[1], asyncio.CancelledError)
+    assert ['/1', '/3'] == started
+    assert 0 == conn._active
+    assert 0 == conn.pending
+    conn.close()
+
+
+def test_shared_session(loop):
+    session = aiohttp.ClientSession(loop=loop)
+    c1 = Connection(Endpoint('http', 'h1', 9999), loop=loop, session=session)
+    c2 = Connection(Endpoint('http', 'h2', 9999), loop=loop, session=session)
+    assert c1._session is c2._session is session
+    c1.close()
+    assert c1.closed
+    assert not c2.closed
+    assert not session.closed
+    session.close()
+
+
+@asyncio.coroutine
+def test_client_error(loop):
+    conn = Connection(Endpoint('http', 'host', 9999), loop=loop)
+    exc = aiohttp.ServerDisconnectedError()
+    conn._session.request = mock.Mock(side_effect=exc)
+
+    with pytest.raises(ConnectionError) as ctx:
+        yield from conn.perform_request('GET', '/data', None, None)
+    assert 'N/A' == ctx.value.status_code
+    assert exc is ctx.value.info
+    conn.close()
@@ -0,0 +1,523 @@
+import asyncio
+import json
+import pytest
+
+from aioes import helpers
+from aioes.exception import BulkIndexError, TransportError
+from aioes.serializer import JSONSerializer
+
+
+INDEX = 'test_elasticsearch'
+
+
+def test_expand_action():
+    assert ({'index': {}}, {'key': 'val'}) == \
+        helpers.expand_action({'key': 'val'})
+
+
+def test_expand_action_string():
+    assert ({'index': {}}, '{"key": "val"}') == \
+        helpers.expand_action('{"key": "val"}')
+
+
+def test_expand_action_actions():
+    assert ({'delete': {'_id': 'id', '_index': 'index'}}, None) == \
+        helpers.expand_action({'_op_type': 'delete', '_id': 'id',
+                               '_index': 'index', '_source': 'ignored'})
+    assert ({'update': {'_id': 'id', '_type': 'type'}}, {'doc': {}}) == \
+        helpers.expand_action({'_op_type': 'update', '_id': 'id',
+                               '_type': 'type', '_source': {'doc': {}}})
+
+
+@asyncio.coroutine
+def read_all(reader):
+    chunks = []
+    while True:
+        chunk = yield from reader.read()
+        if chunk is None:
+            return chunks
+        chunks.append(chunk)
+
+
+@asyncio.coroutine
+def test_chunk_by_count(loop):
+    reader = helpers._ChunkReader(({'n': i} for i in range(5)),
+                                  chunk_size=2, max_chunk_bytes=1 << 20)
+    chunks = yield from read_all(reader)
+    assert [2, 2, 1] == [len(c) for c in chunks]
+    assert [b'{"index": {}}', b'{"n": 4}'] == chunks[-1][0].lines
+
+
+@asyncio.coroutine
+def test_chunk_by_size(loop):
+    # every action is 14 + 9 bytes long including newlines
+    reader = helpers._ChunkReader(({'n': i} for i in range(5)),
+                                  chunk_size=500, max_chunk_bytes=50)
+    chunks = yield from read_all(reader)
+    assert [2, 2, 1] == [len(c) for c in chunks]
+    assert (b'{"index": {}}\n{"n": 0}\n{"index": {}}\n{"n": 1}\n' ==
+            helpers._bulk_body(chunks[0]))
+
+
+@asyncio.coroutine
+def test_chunk_oversized_action(loop):
+    reader = helpers._ChunkReader([{'n': 'x' * 100}, {'n': 1}],
+                                  chunk_size=500, max_chunk_bytes=50)
+    chunks = yield from read_all(reader)
+    assert [1, 1] == [len(c) for c in chunks]
+
+
+@asyncio.coroutine
+def test_streaming_bulk(client):
+    actions = ({'_index': INDEX, '_type': 'type', '_id': str(i), 'n': i}
+               for i in range(10))
+    results = helpers.streaming_bulk(client, actions, chunk_size=3)
+    items = []
+    while True:
+        try:
+            ok, item = yield from results.__anext__()
+        except helpers.StopAsyncIteration:
+            break
+        assert ok
+        items.append(item)
+    assert 10 == len(items)
+    assert [str(i) for i in range(10)] == [i['index']['_id'] for i in items]
+
+
+@asyncio.coroutine
+def test_bulk(client):
+    actions = ({'n': i} for i in range(10))
+    success, errors = yield from helpers.bulk(
+        client, actions, index=INDEX, doc_type='type',
+        chunk_size=4, refresh=True)
+    assert 10 == success
+    assert [] == errors
+    data = yield from client.count(INDEX)
+    assert 10 == data['count']
+
+
+@asyncio.coroutine
+def test_bulk_errors(client):
+    yield from client.index(INDEX, 'type', {'n': 0}, '0', refresh=True)
+    actions = [{'_op_type': 'create', '_id': '0', 'n': 0},
+               {'_op_type': 'create', '_id': '1', 'n': 1}]
+    with pytest.raises(BulkIndexError) as ctx:
+        yield from helpers.bulk(client, actions,
+                                index=INDEX, doc_type='type')
+    assert 1 == len(ctx.value.errors)
+
+    success, failed = yield from helpers.bulk(
+        client, actions, index=INDEX, doc_type='type',
+        raise_on_error=False, stats_only=True)
+    assert (0, 2) == (success, failed)
+
+
+class FakeTransport:
+    """Answers bulk requests without a server, tracking concurrency."""
+
+    def __init__(self, loop, endpoints=1):
+        self.loop = loop
+        self.serializer = JSONSerializer()
+        self.endpoints = [object()] * endpoints
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+
+    @asyncio.coroutine
+    def perform_request(self, method, url, params=None, body=None):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            yield from asyncio.sleep(0.001, loop=self.loop)
+        finally:
+            self.in_flight -= 1
+        lines = body.splitlines()[::2]
+        return 200, {'errors': False,
+                     'items': [{'index': {'status': 201}} for _ in lines]}
+
+
+class FakeClient:
+
+    def __init__(self, loop, endpoints=1):
+        self.transport = FakeTransport(loop, endpoints)
+
+
+@asyncio.coroutine
+def consume(results):
+    items = []
+    while True:
+        try:
+            items.append((yield from results.__anext__()))
+        except helpers.StopAsyncIteration:
+            return items
+
+
+@asyncio.coroutine
+def test_parallel_bulk_concurrency(loop):
+    client = FakeClient(loop, endpoints=2)
+    results = helpers.parallel_bulk(
+        client, ({'n': i} for i in range(100)),
+        chunk_size=5, concurrency=4, loop=loop)
+    items = yield from consume(results)
+    assert 100 == len(items)
+    assert all(ok for ok, _ in items)
+    assert 20 == client.transport.requests
+    assert 4 == client.transport.max_in_flight
+    assert 100 == results.stats.docs
+    assert 20 == results.stats.requests
+    assert 0 == results.stats.errors
+    assert results.stats.docs_per_sec > 0
+
+
+@asyncio.coroutine
+def test_parallel_bulk_error(loop):
+    client = FakeClient(loop)
+
+    def actions():
+        yield {'n': 1}
+        raise ValueError('boom')
+
+    results = helpers.parallel_bulk(client, actions(), loop=loop)
+    with pytest.raises(ValueError):
+        yield from consume(results)
+
+
+@asyncio.coroutine
+def test_parallel_bulk_real(client, loop):
+    results = helpers.parallel_bulk(
+        client, ({'n': i} for i in range(50)),
+        index=INDEX, doc_type='type', chunk_size=10, loop=loop)
+    items = yield from consume(results)
+    assert 50 == len(items)
+    assert 50 == results.stats.docs
+
+
+class RejectingTransport(FakeTransport):
+    """Rejects every second item of the first bulk request."""
+
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.bodies = []
+
+    @asyncio.coroutine
+    def perform_request(self, method, url, params=None, body=None):
+        self.bodies.append(body)
+        docs = body.splitlines()[1::2]
+        if len(self.bodies) == 1:
+            statuses = [429 if i % 2 else 201 for i in range(len(docs))]
+        else:
+            statuses = [201] * len(docs)
+        return 200, {'errors': 429 in statuses,
+                     'items': [{'index': {'status': s, '_id': doc}}
+                               for s, doc in zip(statuses, docs)]}
+
+
+@asyncio.coroutine
+def test_bulk_retry_rejected(loop):
+    client = FakeClient(loop)
+    client.transport = RejectingTransport(loop)
+    results = helpers.streaming_bulk(
+        client, ({'n': i} for i in range(4)), loop=loop,
+        max_retries=2, initial_backoff=0.001)
+    items = yield from consume(results)
+    assert all(ok for ok, _ in items)
+    assert 4 == len(items)
+    assert 2 == len(client.transport.bodies)
+    assert (b'{"index": {}}\n{"n": 1}\n{"index": {}}\n{"n": 3}\n' ==
+            client.transport.bodies[1])
+
+
+@asyncio.coroutine
+def test_bulk_retry_exhausted(loop):
+    client = FakeClient(loop)
+    client.transport = RejectingTransport(loop)
+    success, failed = yield from helpers.bulk(
+        client, ({'n': i} for i in range(4)), loop=loop,
+        raise_on_error=False, stats_only=True)
+    assert (2, 2) == (success, failed)
+    assert 1 == len(client.transport.bodies)
+
+
+class ScrollClient:
+    """Serves ``pages`` of hits through search/scroll api."""
+
+    def __init__(self, loop, pages, fail_on=None):
+        self.loop = loop
+        self.pages = pages
+        self.fail_on = fail_on
+        self.calls = []
+        self.cleared = []
+
+    def _page(self, n):
+        if n == self.fail_on:
+            raise TransportError(500, 'failed')
+        hits = self.pages[n] if n < len(self.pages) else []
+        return {'_scroll_id': 'id{}'.format(n),
+                '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                'hits': {'hits': hits}}
+
+    @asyncio.coroutine
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        self.calls.append(('search', body, kwargs))
+        return self._page(0)
+
+    @asyncio.coroutine
+    def scroll(self, scroll_id, *, scroll):
+        self.calls.append(('scroll', scroll_id))
+        yield from asyncio.sleep(0, loop=self.loop)
+        return self._page(int(scroll_id[2:]) + 1)
+
+    @asyncio.coroutine
+    def clear_scroll(self, scroll_id=None, body=None):
+        self.cleared.append(scroll_id)
+
+
+@asyncio.coroutine
+def test_scan(loop):
+    client = ScrollClient(loop, [[1, 2], [3], [4, 5]])
+    hits = yield from consume(helpers.scan(client, 'index', loop=loop))
+    assert [1, 2, 3, 4, 5] == hits
+    assert ('search', {'sort': '_doc'}, {'scroll': '5m', 'size': 1000}) == \
+        client.calls[0]
+    assert ['id3'] == client.cleared
+
+
+@asyncio.coroutine
+def test_scan_prefetch(loop):
+    client = ScrollClient(loop, [[1, 2], [3]])
+    hits = helpers.scan(client, 'index', loop=loop)
+    assert 1 == (yield from hits.__anext__())
+    yield from asyncio.sleep(0, loop=loop)
+    # the second page is requested before the first one is consumed
+    assert ('scroll', 'id0') == client.calls[-1]
+    yield from hits.close()
+    assert ['id0'] == client.cleared
+
+
+@asyncio.coroutine
+def test_scan_clear_on_error(loop):
+    client = ScrollClient(loop, [[1], [2]], fail_on=1)
+    hits = helpers.scan(client, 'index', loop=loop)
+    assert 1 == (yield from hits.__anext__())
+    with pytest.raises(TransportError):
+        yield from hits.__anext__()
+    assert ['id0'] == client.cleared
+
+
+@asyncio.coroutine
+def test_scan_clear_on_cancel(loop):
+    client = ScrollClient(loop, [[1], [2]])
+    hits = helpers.scan(client, 'index', loop=loop)
+    assert 1 == (yield from hits.__anext__())
+    task = asyncio.ensure_future(hits.__anext__(), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        yield from task
+    assert ['id0'] == client.cleared
+
+
+@asyncio.coroutine
+def test_scan_real(client):
+    yield from helpers.bulk(client, ({'n': i} for i in range(25)),
+                            index=INDEX, doc_type='type', refresh=True)
+    hits = yield from consume(helpers.scan(client, INDEX, size=10))
+    assert list(range(25)) == sorted(h['_source']['n'] for h in hits)
+
+
+class SlicedClient:
+    """Serves one ScrollClient per slice."""
+
+    def __init__(self, loop, slices):
+        self.slices = [ScrollClient(loop, pages) for pages in slices]
+        self.queries = []
+
+    @asyncio.coroutine
+    def search_shards(self, index=None, doc_type=None):
+        return {'shards': [[{}] for _ in self.slices]}
+
+    @asyncio.coroutine
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        self.queries.append(body)
+        slice_id = body['slice']['id']
+        resp = yield from self.slices[slice_id].search(
+            index, doc_type, body, **kwargs)
+        resp['_scroll_id'] = '{}:{}'.format(slice_id, resp['_scroll_id'])
+        return resp
+
+    @asyncio.coroutine
+    def scroll(self, scroll_id, *, scroll):
+        slice_id, scroll_id = scroll_id.split(':')
+        resp = yield from self.slices[int(slice_id)].scroll(
+            scroll_id, scroll=scroll)
+        resp['_scroll_id'] = '{}:{}'.format(slice_id, resp['_scroll_id'])
+        return resp
+
+    @asyncio.coroutine
+    def clear_scroll(self, scroll_id=None, body=None):
+        slice_id, scroll_id = scroll_id.split(':')
+        yield from self.slices[int(slice_id)].clear_scroll(scroll_id)
+
+
+@asyncio.coroutine
+def test_sliced_scan_unordered(loop):
+    client = SlicedClient(loop, [[[1, 2], [3]], [[4], [5, 6]], [[7]]])
+    hits = yield from consume(helpers.sliced_scan(
+        client, 'index', {'query': {'match_all': {}}}, loop=loop))
+    assert list(range(1, 8)) == sorted(hits)
+    assert [{'id': i, 'max': 3} for i in range(3)] == \
+        sorted((q['slice'] for q in client.queries), key=lambda s: s['id'])
+    assert [['id2'], ['id2'], ['id1']] == [c.cleared for c in client.slices]
+
+
+@asyncio.coroutine
+def test_sliced_scan_ordered(loop):
+    def page(*values):
+        return [{'sort': [v, -v], 'v': v} for v in values]
+
+    client = SlicedClient(loop, [[page(1, 4), page(5)],
+                                 [page(2, 3)],
+                                 [page(0), page(6, 7)]])
+    hits = yield from consume(helpers.sliced_scan(
+        client, 'index', {'sort': ['n', {'m': 'desc'}]},
+        ordered=True, loop=loop))
+    assert list(range(8)) == [h['v'] for h in hits]
+    assert 'sort' in client.queries[0]
+
+
+def test_sliced_scan_ordered_no_sort():
+    with pytest.raises(ValueError):
+        helpers.sliced_scan(None, 'index', ordered=True)
+
+
+def test_sort_key_desc():
+    key = helpers._sort_key([{'a': {'order': 'desc'}}, 'b'])
+    hits = [{'sort': [1, 2]}, {'sort': [2, 1]}, {'sort': [1, 1]}]
+    assert [[2, 1], [1, 1], [1, 2]] == \
+        [h['sort'] for h in sorted(hits, key=key)]
+
+
+@asyncio.coroutine
+def test_sliced_scan_real(client, es_tag):
+    if es_tag < (5, 0):
+        pytest.skip("Sliced scroll requires Elasticsearch 5.0+")
+    yield from helpers.bulk(client, ({'n': i} for i in range(25)),
+                            index=INDEX, doc_type='type', refresh=True)
+    hits = yield from consume(helpers.sliced_scan(
+        client, INDEX, slices=3, size=5))
+    assert list(range(25)) == sorted(h['_source']['n'] for h in hits)
+
+
+class PagingClient:
+    """Serves sorted numbers by search_after."""
+
+    def __init__(self, loop, count):
+        self.loop = loop
+        self.count = count
+        self.bodies = []
+
+    @asyncio.coroutine
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        self.bodies.append(body)
+        yield from asyncio.sleep(0, loop=self.loop)
+        start = body['search_after'][0] + 1 if 'search_after' in body else 0
+        stop = min(start + body['size'], self.count)
+        return {'hits': {'hits': [{'sort': [n, str(n)], 'n': n}
+                                  for n in range(start, stop)]}}
+
+
+@asyncio.coroutine
+def test_search_after(loop):
+    client = PagingClient(loop, 7)
+    hits = yield from consume(helpers.search_after(
+        client, 'index', {'sort': ['n']}, size=3, loop=loop))
+    assert list(range(7)) == [h['n'] for h in hits]
+    assert {'sort': ['n', {'_uid': 'asc'}], 'size': 3} == client.bodies[0]
+    assert [2, '2'] == client.bodies[1]['search_after']
+    assert 3 == len(client.bodies)
+
+
+@asyncio.coroutine
+def test_search_after_keeps_tiebreaker(loop):
+    client = PagingClient(loop, 1)
+    yield from consume(helpers.search_after(
+        client, sort=[{'_uid': 'desc'}], loop=loop))
+    assert [{'_uid': 'desc'}] == client.bodies[0]['sort']
+
+
+@asyncio.coroutine
+def test_search_after_resume(loop):
+    client = PagingClient(loop, 10)
+    hits = helpers.search_after(client, sort='n', size=4, loop=loop)
+    for n in range(5):
+        assert n == (yield from hits.__anext__())['n']
+    cursor = hits.cursor
+    yield from hits.close()
+    assert [4, '4'] == cursor
+
+    hits = yield from consume(helpers.search_after(
+        client, sort='n', size=4, cursor=cursor, loop=loop))
+    assert [5, 6, 7, 8, 9] == [h['n'] for h in hits]
+
+
+@asyncio.coroutine
+def test_search_after_real(client, es_tag):
+    if es_tag < (5, 0):
+        pytest.skip("search_after requires Elasticsearch 5.0+")
+    yield from helpers.bulk(client, ({'n': i} for i in range(25)),
+                            index=INDEX, doc_type='type', refresh=True)
+    hits = yield from consume(helpers.search_after(
+        client, INDEX, {'sort': [{'n': 'desc'}]}, size=10))
+    assert list(range(24, -1, -1)) == [h['_source']['n'] for h in hits]
+
+
+@asyncio.coroutine
+def test_reindex(loop):
+    source = ScrollClient(loop, [
+        [{'_index': 'src', '_type': 't', '_id': str(i), '_source': {'n': i}}
+         for i in range(j, j + 3)]
+        for j in range(0, 9, 3)])
+    target = FakeClient(loop)
+    bodies = []
+    perform_request = target.transport.perform_request
+
+    @asyncio.coroutine
+    def record(method, url, params=None, body=None):
+        bodies.append(body)
+        return (yield from perform_request(method, url, params, body))
+
+    target.transport.perform_request = record
+    reports = []
+
+    def transform(hit):
+        if hit['_source']['n'] % 2:
+            return None
+        hit['_source']['n'] *= 10
+        return hit
+
+    stats = yield from helpers.reindex(
+        source, 'src', 'dst', target_client=target, transform=transform,
+        chunk_size=2, progress=reports.append, loop=loop)
+    assert 5 == stats.docs
+    assert 0 == stats.errors
+    assert reports[-1] is stats
+    lines = [json.loads(line.decode('utf-8'))
+             for line in b''.join(bodies).splitlines()]
+    assert {'index': {'_index': 'dst', '_type': 't', '_id': '0'}} in lines
+    assert [0, 20, 40, 60, 80] == sorted(doc['n'] for doc in lines[1::2])
+    assert ['id3'] == source.cleared
+
+
+@asyncio.coroutine
+def test_reindex_real(client):
+    yield from helpers.bulk(client, ({'n': i} for i in range(25)),
+                            index=INDEX, doc_type='type', refresh=True)
+    stats = yield from helpers.reindex(client, INDEX, INDEX + '_copy',
+                                       bulk_kwargs={'refresh': True})
+    try:
+        assert 25 == stats.docs
+        data = yield from client.count(INDEX + '_copy')
+        assert 25 == data['count']
+    finally:
+        yield from client.indices.delete(INDEX + '_copy')
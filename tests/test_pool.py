@@ -1,10 +1,13 @@
 import asyncio
+import math
 import time
 import pytest
 
 from contextlib import closing
 
-from aioes.pool import RandomSelector, RoundRobinSelector, ConnectionPool
+from aioes.pool import (RandomSelector, RoundRobinSelector, EWMASelector,
+                        LeastConnectionsSelector, CircuitBreaker,
+                        ConnectionPool)
 from aioes.transport import Endpoint
 from aioes.connection import Connection
 
@@ -27,6 +30,114 @@ def test_round_robin_select():
     assert 2 == r
 
 
+def test_round_robin_observe():
+    s = RoundRobinSelector()
+    s.observe(1, 0.1)
+    assert 2 == s.select([1, 2, 3])
+
+
+class Conn:
+    # weak referenceable connection stub
+    def __init__(self, in_flight=0):
+        self.in_flight = in_flight
+
+
+def _ewma_selector(**kwargs):
+    s = EWMASelector(**kwargs)
+    now = [0]
+    s.clock = lambda: now[0]
+    return s, now
+
+
+def test_ewma_observe():
+    s, now = _ewma_selector(alpha=0.5)
+    c = Conn()
+    assert 0.5 == s.alpha
+    assert 10 == s.decay
+    assert s.ewma(c) is None
+    s.observe(c, 1.0)
+    assert 1.0 == s.ewma(c)
+    s.observe(c, 2.0)
+    assert 1.5 == s.ewma(c)
+
+
+def test_ewma_decay():
+    s, now = _ewma_selector(alpha=0.5, decay=10)
+    c = Conn()
+    s.observe(c, 1.0)
+    now[0] = 10
+    assert pytest.approx(math.exp(-1)) == s.ewma(c)
+    s.observe(c, 1.0)
+    assert pytest.approx((1 + math.exp(-1)) / 2) == s.ewma(c)
+
+
+def test_ewma_bad_alpha():
+    with pytest.raises(ValueError):
+        EWMASelector(alpha=0)
+    with pytest.raises(ValueError):
+        EWMASelector(alpha=1.5)
+    with pytest.raises(ValueError):
+        EWMASelector(decay=0)
+
+
+def test_ewma_select():
+    s, now = _ewma_selector(seed=123456)
+    fast, medium, slow = Conn(), Conn(), Conn()
+    s.observe(fast, 0.01)
+    s.observe(medium, 0.1)
+    s.observe(slow, 1.0)
+    picks = [s.select([fast, medium, slow]) for i in range(100)]
+    assert picks.count(fast) > picks.count(medium) > 0
+
+
+def test_ewma_select_recovered():
+    s, now = _ewma_selector(seed=123456)
+    fast, slow = Conn(), Conn()
+    s.observe(fast, 0.01)
+    # a single long pause, e.g. GC
+    s.observe(slow, 1.0)
+    assert [fast] * 10 == [s.select([fast, slow]) for i in range(10)]
+    # the slow node isn't observed while fast one keeps serving
+    for i in range(60):
+        now[0] += 1
+        s.observe(fast, 0.01)
+    assert slow is s.select([fast, slow])
+    # the node has recovered, it keeps getting traffic
+    picks = []
+    for i in range(100):
+        conn = s.select([fast, slow])
+        picks.append(conn)
+        s.observe(conn, 0.01)
+    assert picks.count(slow) > 20
+
+
+def test_ewma_select_prefers_unknown():
+    s = EWMASelector(seed=123456)
+    known, unknown = Conn(), Conn()
+    s.observe(known, 0.01)
+    assert unknown is s.select([known, unknown])
+
+
+def test_ewma_select_single():
+    s = EWMASelector()
+    c = Conn()
+    assert c is s.select([c])
+
+
+def test_least_connections_select():
+    s = LeastConnectionsSelector()
+    c1, c2, c3 = Conn(3), Conn(1), Conn(2)
+    assert c2 is s.select([c1, c2, c3])
+    assert c2 is s.select([c1, c2, c3])
+
+
+def test_least_connections_ties():
+    s = LeastConnectionsSelector()
+    c1, c2, c3 = Conn(), Conn(), Conn()
+    picks = [s.select([c1, c2, c3]) for i in range(6)]
+    assert [c2, c3, c1, c2, c3, c1] == picks
+
+
 @pytest.fixture
 def make_pool(loop, make_connection):
     pool = None
@@ -50,7 +161,7 @@ def test_ctor(make_pool):
     assert abs(60-pool.dead_timeout) < 1e-6
     assert 5 == pool.timeout_cutoff
     assert 0 == len(pool._dead_count)
-    assert pool._dead.empty()
+    assert not pool._dead_entries
 
 
 @asyncio.coroutine
@@ -88,9 +199,9 @@ def test_mark_dead(make_pool):
     yield from pool.mark_dead(conn)
     t1 = time.monotonic() + pool.dead_timeout
     assert [] == pool.connections
-    assert not pool._dead.empty()
+    assert 1 == len(pool._dead_entries)
     assert 1 == pool._dead_count[conn]
-    timeout, conn2 = yield from pool._dead.get()
+    timeout, _, conn2 = pool._dead_entries[conn]
     assert conn is conn2
     assert t0 <= timeout <= t1, (t0, timeout, t1)
 
@@ -101,7 +212,7 @@ def test_mark_dead_unknown(make_pool):
     conn = pool.connections[0]
     yield from pool.mark_dead("unknown")
     assert 0 == len(pool._dead_count)
-    assert pool._dead.empty()
+    assert not pool._dead_entries
     assert [conn] == pool.connections
 
 
@@ -116,9 +227,9 @@ def test_mark_dead_twice(make_pool):
     yield from pool.mark_dead(conn)
     t1 = time.monotonic() + pool.dead_timeout * 2
     assert [] == pool.connections
-    assert not pool._dead.empty()
+    assert 1 == len(pool._dead_entries)
     assert 2 == pool._dead_count[conn]
-    timeout, conn2 = yield from pool._dead.get()
+    timeout, _, conn2 = pool._dead_entries[conn]
     assert conn is conn2
     assert t0 <= timeout <= t1, (t0, timeout, t1)
 
@@ -134,9 +245,9 @@ def test_mark_dead_after_cutoff(make_pool):
     yield from pool.mark_dead(conn)
     t1 = time.monotonic() + pool.dead_timeout * 2 ** 5
     assert [] == pool.connections
-    assert not pool._dead.empty()
+    assert 1 == len(pool._dead_entries)
     assert 8 == pool._dead_count[conn]
-    timeout, conn2 = yield from pool._dead.get()
+    timeout, _, conn2 = pool._dead_entries[conn]
     assert conn is conn2
     assert t0 <= timeout <= t1, (t0, timeout, t1)
 
@@ -171,9 +282,9 @@ def test_resurrect(loop, make_pool):
         yield from pool.mark_dead(c1)
         yield from pool.mark_dead(c2)
         yield from pool.resurrect()
-        assert 2 == pool._dead.qsize()
+        assert 2 == len(pool._dead_entries)
         yield from pool.resurrect(True)
-        assert 1 == pool._dead.qsize()
+        assert 1 == len(pool._dead_entries)
         assert [c1] == pool.connections
 
 
@@ -188,5 +299,384 @@ def test_get_connection(loop, make_pool):
         yield from pool.mark_dead(c2)
 
         conn = yield from pool.get_connection()
-        assert 1 == pool._dead.qsize()
+        assert 1 == len(pool._dead_entries)
+        assert c1 is conn
+
+
+def test_add_remove(loop, make_pool):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    with closing(c1), closing(c2):
+        pool = make_pool(connections=[c1])
+        pool.add(c2)
+        pool.add(c2)
+        assert [c1, c2] == pool.connections
+        pool.remove(c1)
+        pool.remove(c1)
+        assert [c2] == pool.connections
+        assert [c2] == pool.all_connections
+        assert not c1.closed
+
+
+@asyncio.coroutine
+def test_remove_dead(loop, make_pool):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    with closing(c1), closing(c2):
+        pool = make_pool(connections=[c1, c2])
+        yield from pool.mark_dead(c1)
+        yield from pool.mark_dead(c2)
+        assert {c1, c2} == set(pool.all_connections)
+
+        pool.remove(c1)
+        assert 1 == len(pool._dead_entries)
+        assert c1 not in pool._dead_count
+        assert [c2] == pool.all_connections
+        yield from pool.resurrect(True)
+        assert [c2] == pool.connections
+
+
+def test_observe(make_pool):
+    pool = make_pool()
+    pool._selector = EWMASelector()
+    conn = pool.connections[0]
+    pool.observe(conn, 0.5)
+    assert 0.49 < pool.selector.ewma(conn) <= 0.5
+
+
+def _probe_result(loop, conn, exc=None):
+    calls = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body):
+        calls.append((method, url))
+        if exc is not None:
+            raise exc
+        return 200, {}, ''
+
+    conn.perform_request = perform_request
+    return calls
+
+
+@asyncio.coroutine
+def test_health_check(loop):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    c3 = Connection(Endpoint('http', 'h3', 3), loop=loop)
+    pool = ConnectionPool([c1, c2, c3], dead_timeout=0,
+                          health_check_interval=1000, loop=loop)
+    calls1 = _probe_result(loop, c1)
+    calls2 = _probe_result(loop, c2, ConnectionError('failed'))
+    try:
+        assert 1000 == pool.health_check_interval
+        yield from pool.mark_dead(c1)
+        yield from pool.mark_dead(c2)
+        yield from pool.resurrect()
+        assert [c3] == pool.connections
+
+        yield from pool.health_check()
+        assert [('HEAD', '/')] == calls1
+        assert [('HEAD', '/')] == calls2
+        assert [c3, c1] == pool.connections
+        assert 1 == len(pool._dead_entries)
+        assert 2 == pool._dead_count[c2]
+    finally:
+        pool.close()
+
+
+@asyncio.coroutine
+def test_health_check_not_due(loop):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    pool = ConnectionPool([c1], health_check_interval=1000, loop=loop)
+    calls = _probe_result(loop, c1)
+    try:
+        yield from pool.mark_dead(c1)
+        yield from pool.health_check()
+        assert [] == calls
+        assert 1 == len(pool._dead_entries)
+        # forced resurrection still works
+        conn = yield from pool.get_connection()
+        assert c1 is conn
+    finally:
+        pool.close()
+
+
+@asyncio.coroutine
+def test_health_check_removed_while_probing(loop):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    pool = ConnectionPool([c1, c2], dead_timeout=0,
+                          health_check_interval=1000, loop=loop)
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body):
+        pool.remove(c1)
+        return 200, {}, ''
+
+    c1.perform_request = perform_request
+    try:
+        yield from pool.mark_dead(c1)
+        yield from pool.health_check()
+        assert [c2] == pool.connections
+    finally:
+        c1.close()
+        pool.close()
+
+
+@asyncio.coroutine
+def test_health_check_force_resurrect_while_probing(loop):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    pool = ConnectionPool([c1], dead_timeout=0,
+                          health_check_interval=1000, loop=loop)
+    gate = asyncio.Future(loop=loop)
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body):
+        yield from gate
+        raise ConnectionError('failed')
+
+    c1.perform_request = perform_request
+    try:
+        yield from pool.mark_dead(c1)
+        checker = asyncio.ensure_future(pool.health_check(), loop=loop)
+        yield from asyncio.sleep(0, loop=loop)
+        assert [] == pool.connections
+        # the only connection is being probed, it's resurrected by force
+        conn = yield from pool.get_connection()
+        assert c1 is conn
+        gate.set_result(None)
+        yield from checker
+        assert [c1] == pool.connections
+        assert not pool._probing
+    finally:
+        pool.close()
+
+
+@asyncio.coroutine
+def test_health_check_background(loop):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    pool = ConnectionPool([c1, c2], dead_timeout=0,
+                          health_check_interval=0.01, loop=loop)
+    _probe_result(loop, c1)
+    try:
+        yield from pool.mark_dead(c1)
+        yield from asyncio.sleep(0.05, loop=loop)
+        assert c1 in pool.connections
+    finally:
+        pool.close()
+    assert pool._health_checker is None
+
+
+@asyncio.coroutine
+def test_mark_dead_keeps_live_index(loop, make_pool):
+    conns = [Connection(Endpoint('http', 'h{}'.format(i), i), loop=loop)
+             for i in range(5)]
+    pool = make_pool(connections=list(conns))
+    try:
+        yield from pool.mark_dead(conns[1])
+        yield from pool.mark_dead(conns[4])
+        assert {conns[0], conns[2], conns[3]} == set(pool.connections)
+        for i, conn in enumerate(pool._connections):
+            assert i == pool._live[conn]
+        pool.remove(conns[0])
+        for i, conn in enumerate(pool._connections):
+            assert i == pool._live[conn]
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+@asyncio.coroutine
+def test_resurrect_order(loop, make_pool):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    c3 = Connection(Endpoint('http', 'h3', 3), loop=loop)
+    with closing(c1), closing(c2), closing(c3):
+        pool = make_pool(connections=[c1, c2, c3])
+        pool._dead_count[c1] = 2
+        yield from pool.mark_dead(c1)
+        yield from pool.mark_dead(c2)
+        yield from pool.mark_dead(c3)
+        # removed entries are skipped
+        pool.remove(c2)
+        yield from pool.resurrect(True)
+        assert [c3] == pool.connections
+        yield from pool.resurrect(True)
+        assert {c1, c3} == set(pool.connections)
+        assert not pool._dead_entries
+        yield from pool.resurrect(True)
+        assert [] == pool._dead
+
+
+@asyncio.coroutine
+def test_resurrect_eligible(loop, make_pool):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    with closing(c1):
+        pool = make_pool(connections=[c1])
+        pool._dead_timeout = 0
+        yield from pool.mark_dead(c1)
+        conn = yield from pool.get_connection()
         assert c1 is conn
+        assert not pool._dead_entries
+
+
+def test_circuit_breaker_trip():
+    cb = CircuitBreaker(window=10, min_requests=4, error_threshold=0.5)
+    assert CircuitBreaker.CLOSED == cb.state
+    assert '<CircuitBreaker closed>' == repr(cb)
+    cb.record(True)
+    cb.record(True)
+    cb.record(True)
+    # not enough requests yet
+    assert CircuitBreaker.CLOSED == cb.state
+    cb.record(False)
+    assert CircuitBreaker.OPEN == cb.state
+    assert not cb.available()
+
+
+def test_circuit_breaker_sliding_window():
+    cb = CircuitBreaker(window=4, min_requests=4, error_threshold=0.5)
+    cb.record(True)
+    for i in range(6):
+        cb.record(False)
+    cb.record(True)
+    # the first failure left the window
+    assert CircuitBreaker.CLOSED == cb.state
+    cb.record(True)
+    assert CircuitBreaker.OPEN == cb.state
+
+
+def test_circuit_breaker_latency():
+    cb = CircuitBreaker(min_requests=2, latency_threshold=0.5)
+    cb.record(False, 0.1)
+    cb.record(False, 1.0)
+    assert CircuitBreaker.OPEN == cb.state
+
+
+def test_circuit_breaker_half_open():
+    cb = CircuitBreaker(min_requests=1, reset_timeout=0,
+                        half_open_requests=2)
+    cb.record(True)
+    assert CircuitBreaker.HALF_OPEN == cb.state
+    assert cb.available()
+    cb.acquire()
+    cb.acquire()
+    # probe limit is reached
+    assert not cb.available()
+    cb.record(False)
+    assert CircuitBreaker.HALF_OPEN == cb.state
+    cb.record(False)
+    assert CircuitBreaker.CLOSED == cb.state
+
+
+def test_circuit_breaker_half_open_failure():
+    cb = CircuitBreaker(min_requests=1, reset_timeout=1000)
+    cb.record(True)
+    cb._opened_at -= 1000
+    assert CircuitBreaker.HALF_OPEN == cb.state
+    cb.acquire()
+    cb.record(True)
+    assert CircuitBreaker.OPEN == cb.state
+    # late responses are ignored
+    cb.record(False)
+    assert CircuitBreaker.OPEN == cb.state
+
+
+def test_circuit_breaker_release():
+    cb = CircuitBreaker(min_requests=1, reset_timeout=1000,
+                        half_open_requests=2)
+    assert not cb.acquire()
+    cb.release()
+    cb.record(True)
+    assert cb.reset_at == cb._opened_at + 1000
+    cb._opened_at -= 1000
+    assert cb.acquire()
+    assert cb.acquire()
+    assert not cb.available()
+    # requests were cancelled without recording outcome
+    cb.release()
+    cb.release()
+    cb.release()
+    assert cb.available()
+    assert 0 == cb._probes
+    assert cb.reset_at is None
+
+
+@asyncio.coroutine
+def test_circuit_breaker_pool_release(loop):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    pool = ConnectionPool(
+        [c1, c2], loop=loop,
+        circuit_breaker_factory=lambda: CircuitBreaker(
+            min_requests=1, reset_timeout=0.01, half_open_requests=1))
+    try:
+        pool.observe_failure(c1)
+        assert [c2] == pool._available
+        yield from asyncio.sleep(0.02, loop=loop)
+        conns = set()
+        for i in range(4):
+            conns.add((yield from pool.get_connection()))
+        # the only probe slot is taken
+        assert {c1, c2} == conns
+        assert [c2] == pool._available
+        pool.release(c1)
+        assert {c1, c2} == set(pool._available)
+    finally:
+        pool.close()
+
+
+@asyncio.coroutine
+def test_circuit_breaker_selection(loop):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    pool = ConnectionPool(
+        [c1, c2], loop=loop,
+        circuit_breaker_factory=lambda: CircuitBreaker(min_requests=1,
+                                                       reset_timeout=1000))
+    try:
+        assert isinstance(pool.circuit_breaker(c1), CircuitBreaker)
+        pool.observe_failure(c1)
+        for i in range(4):
+            conn = yield from pool.get_connection()
+            assert c2 is conn
+
+        # all breakers are open, use live connections anyway
+        pool.observe_failure(c2)
+        conns = set()
+        for i in range(4):
+            conns.add((yield from pool.get_connection()))
+        assert {c1, c2} == conns
+
+        pool.circuit_breaker(c1)._opened_at -= 1000
+        pool.observe(c1, 0.1)
+        pool.observe(c1, 0.1)
+        pool.observe(c1, 0.1)
+        assert CircuitBreaker.CLOSED == pool.circuit_breaker(c1).state
+        assert {c2} == pool._tripped
+    finally:
+        pool.close()
+
+
+def test_circuit_breaker_add_remove(loop):
+    c1 = Connection(Endpoint('http', 'h1', 1), loop=loop)
+    c2 = Connection(Endpoint('http', 'h2', 2), loop=loop)
+    pool = ConnectionPool([c1], loop=loop,
+                          circuit_breaker_factory=CircuitBreaker)
+    try:
+        pool.add(c2)
+        assert pool.circuit_breaker(c2) is not None
+        pool.remove(c1)
+        assert pool.circuit_breaker(c1) is None
+    finally:
+        c1.close()
+        pool.close()
+
+
+def test_no_circuit_breaker(make_pool):
+    pool = make_pool()
+    conn = pool.connections[0]
+    assert pool.circuit_breaker(conn) is None
+    pool.observe_failure(conn)
+    assert not pool._tripped
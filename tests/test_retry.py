@@ -0,0 +1,170 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from aioes.exception import (ConnectionError, NotFoundError, QueueFullError,
+                             TransportError)
+from aioes.retry import HedgePolicy, RetryBudget, RetryPolicy, backoff
+
+
+def test_ctor():
+    policy = RetryPolicy()
+    assert 3 == policy.max_retries
+    assert {502, 503, 504} == policy.retry_on_status
+    assert not policy.retry_on_timeout
+    assert '<RetryPolicy max_retries=3>' == repr(policy)
+
+
+@pytest.mark.parametrize('method,url', [
+    ('GET', '/index/doc/1'),
+    ('HEAD', '/'),
+    ('PUT', '/index/doc/1'),
+    ('DELETE', '/index'),
+    ('POST', '/index/_search'),
+    ('POST', '/_search/'),
+    ('post', '/index/doc/_count'),
+    ('POST', '/_mget'),
+    ('POST', '/_msearch'),
+])
+def test_idempotent(method, url):
+    assert RetryPolicy().is_idempotent(method, url)
+
+
+@pytest.mark.parametrize('method,url', [
+    ('POST', '/_bulk'),
+    ('POST', '/index/doc'),
+    ('POST', '/index/doc/1/_update'),
+    ('POST', '/_search/scroll'),
+])
+def test_not_idempotent(method, url):
+    assert not RetryPolicy().is_idempotent(method, url)
+
+
+def test_retryable_status():
+    policy = RetryPolicy()
+    assert policy.is_retryable('GET', '/', TransportError(503, 'err', None))
+    assert not policy.is_retryable('POST', '/_bulk',
+                                   TransportError(503, 'err', None))
+    assert not policy.is_retryable('GET', '/', NotFoundError(404, 'err', None))
+    assert not policy.is_retryable('GET', '/',
+                                   QueueFullError('N/A', 'full', None))
+
+
+def test_retryable_connection_error():
+    policy = RetryPolicy()
+    exc = ConnectionError('N/A', 'err', aiohttp.ServerDisconnectedError())
+    assert policy.is_retryable('GET', '/', exc)
+    assert not policy.is_retryable('POST', '/_bulk', exc)
+
+
+def test_retryable_connect_error():
+    policy = RetryPolicy()
+    exc = ConnectionError('N/A', 'err',
+                          aiohttp.ClientConnectorError(111, 'refused'))
+    # request wasn't sent at all
+    assert policy.is_retryable('POST', '/_bulk', exc)
+
+
+def test_retryable_timeout():
+    assert not RetryPolicy().is_retryable('GET', '/', asyncio.TimeoutError())
+    policy = RetryPolicy(retry_on_timeout=True)
+    assert policy.is_retryable('GET', '/', asyncio.TimeoutError())
+    assert not policy.is_retryable('POST', '/_bulk', asyncio.TimeoutError())
+
+
+def test_retryable_other():
+    assert not RetryPolicy().is_retryable('GET', '/', ValueError())
+
+
+def test_should_retry():
+    policy = RetryPolicy(2)
+    exc = TransportError(503, 'err', None)
+    assert policy.should_retry(0, 'GET', '/', exc)
+    assert policy.should_retry(1, 'GET', '/', exc)
+    assert not policy.should_retry(2, 'GET', '/', exc)
+
+
+def test_backoff():
+    for attempt in range(1, 10):
+        delay = backoff(attempt, 1, 10)
+        assert 0 <= delay <= min(10, 2 ** (attempt - 1))
+    policy = RetryPolicy(initial_backoff=0.5, max_backoff=1)
+    assert 0 <= policy.backoff(5) <= 1
+
+
+def test_budget_ctor():
+    budget = RetryBudget()
+    assert 0.1 == budget.ratio
+    assert 10 <= budget.tokens <= 10.1
+    assert repr(budget).startswith('<RetryBudget ratio=0.1 tokens=')
+    with pytest.raises(ValueError):
+        RetryBudget(-1)
+
+
+def test_budget_withdraw():
+    budget = RetryBudget(0.5, min_retries_per_sec=0)
+    assert 0 == budget.tokens
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def test_budget_capacity():
+    budget = RetryBudget(1, min_retries_per_sec=0, capacity=2)
+    for i in range(10):
+        budget.deposit()
+    assert 2 == budget.tokens
+
+
+def test_budget_refill():
+    budget = RetryBudget(0, min_retries_per_sec=10, capacity=5)
+    budget._tokens = 0
+    budget._last_refill -= 0.25
+    assert 2.5 <= budget.tokens < 3
+    budget._last_refill -= 10
+    assert 5 == budget.tokens
+
+
+def test_hedge_ctor():
+    policy = HedgePolicy()
+    assert 95 == policy.percentile
+    assert '<HedgePolicy percentile=95>' == repr(policy)
+    with pytest.raises(ValueError):
+        HedgePolicy(0)
+    with pytest.raises(ValueError):
+        HedgePolicy(101)
+
+
+def test_hedge_delay():
+    policy = HedgePolicy(90, min_samples=10, min_delay=0.01)
+    for i in range(9):
+        policy.observe(i + 1)
+    assert policy.delay() is None
+    policy.observe(10)
+    assert 9 == policy.delay()
+
+
+def test_hedge_delay_min():
+    policy = HedgePolicy(min_samples=1, min_delay=0.5)
+    policy.observe(0.1)
+    assert 0.5 == policy.delay()
+
+
+def test_hedge_delay_window():
+    policy = HedgePolicy(100, window=5, min_samples=1)
+    for i in range(10):
+        policy.observe(10 - i)
+    assert 5 == policy.delay()
+
+
+def test_hedge_allow():
+    policy = HedgePolicy(max_ratio=0.5)
+    assert not policy.allow()
+    policy.deposit()
+    policy.deposit()
+    assert policy.allow()
+    assert not policy.allow()
@@ -0,0 +1,58 @@
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+from aioes.exception import SerializationError
+from aioes.serializer import (JSONSerializer, SERIALIZERS,
+                              fastest_serializer)
+
+
+def test_dumps_returns_bytes():
+    assert b'{"a": 1}' == JSONSerializer().dumps({'a': 1})
+
+
+def test_dumps_custom_types():
+    data = {'d': date(2017, 1, 2),
+            'dt': datetime(2017, 1, 2, 3, 4, 5),
+            'dec': Decimal('1.5'),
+            'id': uuid.UUID('12345678123456781234567812345678')}
+    assert ({'d': '2017-01-02',
+             'dt': '2017-01-02T03:04:05',
+             'dec': 1.5,
+             'id': '12345678-1234-5678-1234-567812345678'} ==
+            JSONSerializer().loads(JSONSerializer().dumps(data)))
+
+
+def test_dumps_error():
+    with pytest.raises(SerializationError):
+        JSONSerializer().dumps({'a': object()})
+
+
+def test_loads_str_and_bytes():
+    s = JSONSerializer()
+    assert {'a': 'ю'} == s.loads('{"a": "ю"}')
+    assert {'a': 'ю'} == s.loads('{"a": "ю"}'.encode('utf-8'))
+
+
+def test_loads_error():
+    with pytest.raises(SerializationError):
+        JSONSerializer().loads('{')
+
+
+def test_stdlib_is_always_available():
+    assert JSONSerializer is SERIALIZERS['json']
+    assert isinstance(fastest_serializer(), tuple(SERIALIZERS.values()))
+
+
+@pytest.mark.parametrize('name', list(SERIALIZERS))
+def test_roundtrip(name):
+    s = SERIALIZERS[name]()
+    data = {'str': 'данные', 'int': 1, 'float': 1.5, 'list': [None, True],
+            'dec': Decimal('2.5')}
+    encoded = s.dumps(data)
+    assert isinstance(encoded, bytes)
+    data['dec'] = 2.5
+    assert data == s.loads(encoded)
+    assert data == s.loads(encoded.decode('utf-8'))
@@ -1,10 +1,19 @@
 import aiohttp
 import asyncio
+import functools
+import gzip
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
 import pytest
 
-from aioes.transport import Endpoint, Transport
+from aioes.exception import ConnectionError, TransportError
+from aioes.pool import (CircuitBreaker, EWMASelector,
+                        LeastConnectionsSelector)
+from aioes.retry import HedgePolicy, RetryBudget, RetryPolicy
+from aioes.serializer import JSONSerializer
+from aioes.transport import Endpoint, RawResponse, Transport
 
 
 @pytest.fixture
@@ -49,6 +58,7 @@ def test_connector_factory(es_params, loop):
     )
     assert 1 == len(tr._pool.connections)
     assert TCPConnector.used
+    assert isinstance(tr._session.connector, TCPConnector)
     tr.close()
 
 
@@ -170,8 +180,8 @@ def test_sniff(make_transport, loop):
     tr = make_transport(sniffer_interval=0.001)
 
     t0 = time.monotonic()
-    yield from asyncio.sleep(0.001, loop=loop)
-    yield from tr.get_connection()
+    # sniffing is done by background task
+    yield from asyncio.sleep(0.1, loop=loop)
     assert tr.last_sniff > t0
 
 
@@ -192,3 +202,908 @@ def test_perform_request_body_bytes(make_transport):
         'GET', '/_nodes/_all', body=b'')
 
     assert status == 200
+
+
+def test_serializer(loop):
+    serializer = JSONSerializer()
+    tr = Transport(['localhost'], loop=loop, serializer=serializer)
+    try:
+        assert serializer is tr.serializer
+        assert serializer is tr._pool.connections[0]._serializer
+    finally:
+        tr.close()
+
+
+def test_default_serializer(make_transport):
+    tr = make_transport()
+    assert isinstance(tr.serializer, JSONSerializer)
+
+
+@asyncio.coroutine
+def test_perform_request_raw(loop):
+    tr = Transport(['localhost'], loop=loop)
+    calls = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, *, headers=None,
+                        raw=False):
+        calls.append(raw)
+        return 200, {'Content-Type': 'application/json'}, b'{"a": 1}'
+
+    try:
+        tr._pool.connections[0].perform_request = perform_request
+        status, data = yield from tr.perform_request('GET', '/', raw=True)
+        assert 200 == status
+        assert RawResponse({'Content-Type': 'application/json'},
+                           b'{"a": 1}') == data
+        status, data = yield from tr.perform_request('GET', '/')
+        assert {'a': 1} == data
+        assert [True, False] == calls
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_offload(loop):
+    def func(arg):
+        return arg, threading.get_ident()
+
+    with ThreadPoolExecutor(1) as executor:
+        tr = Transport([], loop=loop, executor=executor,
+                       offload_threshold=10)
+        assert 10 == tr.offload_threshold
+        ret, ident = yield from tr.offload(9, func, 'a')
+        assert 'a' == ret
+        assert threading.get_ident() == ident
+        ret, ident = yield from tr.offload(10, func, 'b')
+        assert 'b' == ret
+        assert threading.get_ident() != ident
+        ret, ident = yield from tr.offload(None, func, 'c')
+        assert threading.get_ident() != ident
+
+
+@asyncio.coroutine
+def test_offload_default_loop(loop):
+    with ThreadPoolExecutor(1) as executor:
+        tr = Transport([], loop=None, executor=executor,
+                       offload_threshold=1)
+        try:
+            ident = yield from tr.offload(10, threading.get_ident)
+            assert threading.get_ident() != ident
+        finally:
+            tr.close()
+
+
+@asyncio.coroutine
+def test_offload_disabled(loop):
+    tr = Transport([], loop=loop)
+    assert tr.offload_threshold is None
+    ret = yield from tr.offload(None, threading.get_ident)
+    assert threading.get_ident() == ret
+
+
+@asyncio.coroutine
+def test_perform_request_offload_decoding(loop):
+    threads = []
+
+    def decoder(data):
+        threads.append(threading.get_ident())
+        return data
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, **kwargs):
+        return 200, {}, '{"a": 1}'
+
+    with ThreadPoolExecutor(1) as executor:
+        tr = Transport(['localhost'], loop=loop, executor=executor,
+                       offload_threshold=5)
+        try:
+            tr._pool.connections[0].perform_request = perform_request
+            status, data = yield from tr.perform_request(
+                'GET', '/', decoder=decoder)
+            assert '{"a": 1}' == data
+            assert threading.get_ident() != threads[0]
+        finally:
+            tr.close()
+
+
+@asyncio.coroutine
+def test_perform_request_compress(loop):
+    calls = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, *, headers=None,
+                        raw=False):
+        calls.append((body, headers))
+        return 200, {}, ''
+
+    tr = Transport(['localhost'], loop=loop, http_compress=True,
+                   compress_threshold=10)
+    try:
+        assert tr.http_compress
+        assert 10 == tr.compress_threshold
+        tr._pool.connections[0].perform_request = perform_request
+        yield from tr.perform_request('POST', '/', body=b'short')
+        yield from tr.perform_request('POST', '/', body=b'x' * 100)
+        yield from tr.perform_request('GET', '/')
+    finally:
+        tr.close()
+
+    body, headers = calls[0]
+    assert b'short' == body
+    assert {'Accept-Encoding': 'gzip,deflate'} == headers
+    body, headers = calls[1]
+    assert b'x' * 100 == gzip.decompress(body)
+    assert {'Accept-Encoding': 'gzip,deflate',
+            'Content-Encoding': 'gzip'} == headers
+    body, headers = calls[2]
+    assert body is None
+    assert {'Accept-Encoding': 'gzip,deflate'} == headers
+
+
+@asyncio.coroutine
+def test_perform_request_no_compress(loop):
+    calls = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, *, headers=None,
+                        raw=False):
+        calls.append((body, headers))
+        return 200, {}, ''
+
+    tr = Transport(['localhost'], loop=loop)
+    try:
+        assert not tr.http_compress
+        tr._pool.connections[0].perform_request = perform_request
+        yield from tr.perform_request('POST', '/', body=b'x' * 2000)
+    finally:
+        tr.close()
+    assert [(b'x' * 2000, None)] == calls
+
+
+@asyncio.coroutine
+def test_sniff_single_flight(loop):
+    tr = Transport(['localhost'], loop=loop)
+    calls = []
+
+    @asyncio.coroutine
+    def sniff():
+        calls.append(1)
+        yield from asyncio.sleep(0.01, loop=loop)
+
+    tr._sniff = sniff
+    try:
+        yield from asyncio.gather(*[tr.sniff_endpoints() for i in range(10)],
+                                  loop=loop)
+        assert 1 == len(calls)
+        assert tr._sniffing is None
+        yield from tr.sniff_endpoints()
+        assert 2 == len(calls)
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_sniff_single_flight_error(loop):
+    tr = Transport(['localhost'], loop=loop)
+
+    @asyncio.coroutine
+    def sniff():
+        yield from asyncio.sleep(0.01, loop=loop)
+        raise TransportError("N/A", "Unable to sniff endpoints.")
+
+    tr._sniff = sniff
+    try:
+        ret = yield from asyncio.gather(
+            tr.sniff_endpoints(), tr.sniff_endpoints(),
+            loop=loop, return_exceptions=True)
+        assert all(isinstance(e, TransportError) for e in ret)
+        assert tr._sniffing is None
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_sniff_waiter_cancellation(loop):
+    tr = Transport(['localhost'], loop=loop)
+    done = []
+
+    @asyncio.coroutine
+    def sniff():
+        yield from asyncio.sleep(0.01, loop=loop)
+        done.append(1)
+
+    tr._sniff = sniff
+    try:
+        waiter = asyncio.ensure_future(tr.sniff_endpoints(), loop=loop)
+        yield from asyncio.sleep(0, loop=loop)
+        waiter.cancel()
+        yield from tr.sniff_endpoints()
+        assert [1] == done
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_mark_dead_sniff_rate_limit(loop):
+    tr = Transport(['localhost'], loop=loop, min_sniff_interval=1000)
+    calls = []
+
+    @asyncio.coroutine
+    def sniff():
+        calls.append(1)
+
+    tr._sniff = sniff
+    try:
+        assert 1000 == tr.min_sniff_interval
+        conn = tr._pool.connections[0]
+        yield from tr._mark_dead(conn)
+        yield from tr._mark_dead(conn)
+        assert 1 == len(calls)
+
+        tr._min_sniff_interval = 0
+        yield from tr._mark_dead(conn)
+        assert 2 == len(calls)
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_close_cancels_sniffing(loop):
+    tr = Transport(['localhost'], loop=loop)
+
+    @asyncio.coroutine
+    def sniff():
+        yield from asyncio.sleep(10, loop=loop)
+
+    tr._sniff = sniff
+    waiter = asyncio.ensure_future(tr.sniff_endpoints(), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+    sniffing = tr._sniffing
+    tr.close()
+    with pytest.raises(asyncio.CancelledError):
+        yield from waiter
+    assert sniffing.cancelled()
+
+
+@asyncio.coroutine
+def test_background_sniffer(loop):
+    calls = []
+
+    @asyncio.coroutine
+    def sniff():
+        calls.append(1)
+        tr._last_sniff = time.monotonic()
+
+    tr = Transport(['localhost'], loop=loop, sniffer_interval=0.01)
+    tr._sniff = sniff
+    try:
+        yield from asyncio.sleep(0.035, loop=loop)
+        assert 2 <= len(calls) <= 4
+    finally:
+        tr.close()
+    assert tr._sniffer is None
+
+
+@asyncio.coroutine
+def test_get_connection_doesnt_sniff(loop):
+    calls = []
+
+    @asyncio.coroutine
+    def sniff():
+        calls.append(1)
+
+    tr = Transport(['localhost'], loop=loop, sniffer_interval=0.01)
+    tr._sniff = sniff
+    tr._last_sniff -= 1
+    try:
+        yield from tr.get_connection()
+        assert [] == calls
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_background_sniffer_failure(loop):
+    calls = []
+
+    @asyncio.coroutine
+    def sniff():
+        calls.append(1)
+        raise TransportError("N/A", "Unable to sniff endpoints.")
+
+    tr = Transport(['localhost'], loop=loop, sniffer_interval=0.01)
+    tr._sniff = sniff
+    try:
+        yield from asyncio.sleep(0.035, loop=loop)
+        assert 2 <= len(calls) <= 4
+        assert not tr._sniffer.done()
+    finally:
+        tr.close()
+
+
+def test_no_background_sniffer(loop):
+    tr = Transport(['localhost'], loop=loop)
+    assert tr._sniffer is None
+    tr.close()
+
+
+@asyncio.coroutine
+def test_set_endpoints_incremental(loop):
+    tr = Transport(['h1', 'h2'], loop=loop)
+    try:
+        c1, c2 = sorted(tr._pool.connections, key=lambda c: c.endpoint.host)
+        yield from tr._pool.mark_dead(c2)
+
+        tr.endpoints = ['h2', 'h3']
+        conns = {c.endpoint.host: c for c in tr._pool.all_connections}
+        assert {'h2', 'h3'} == set(conns)
+        # state of existing connections is kept
+        assert c2 is conns['h2']
+        assert 1 == tr._pool._dead_count[c2]
+        assert [conns['h3']] == tr._pool.connections
+        # removed seed connection is kept open for sniffing
+        assert not c1.closed
+    finally:
+        tr.close()
+    assert c1.closed
+
+
+@asyncio.coroutine
+def test_set_endpoints_drains_removed(loop):
+    tr = Transport(['h1'], loop=loop)
+    try:
+        tr.endpoints = ['h2']
+        conn = tr._pool.connections[0]
+        conn._in_flight = 1
+        tr.endpoints = ['h3']
+        assert not conn.closed
+        assert conn not in tr._pool.all_connections
+        conn._in_flight = 0
+        conn.close_when_idle()
+        assert conn.closed
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_perform_request_observe(loop):
+    tr = Transport(['localhost'], loop=loop, selector_factory=EWMASelector)
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, **kwargs):
+        yield from asyncio.sleep(0.01, loop=loop)
+        return 200, {}, ''
+
+    try:
+        conn = tr._pool.connections[0]
+        conn.perform_request = perform_request
+        yield from tr.perform_request('GET', '/')
+        assert 0.005 <= tr._pool.selector.ewma(conn) < 0.1
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_least_connections(loop):
+    tr = Transport(['h1', 'h2'], loop=loop,
+                   selector_factory=LeastConnectionsSelector)
+    fut = asyncio.Future(loop=loop)
+    hosts = []
+
+    try:
+        for conn in tr._pool.connections:
+
+            @asyncio.coroutine
+            def _perform_request(method, url, params, body, *, conn=conn,
+                                 **kwargs):
+                hosts.append(conn.endpoint.host)
+                yield from fut
+                return 200, {}, ''
+            conn._perform_request = _perform_request
+
+        tasks = [asyncio.ensure_future(tr.perform_request('GET', '/'),
+                                       loop=loop) for i in range(4)]
+        yield from asyncio.sleep(0.01, loop=loop)
+        assert ['h1', 'h1', 'h2', 'h2'] == sorted(hosts)
+        fut.set_result(None)
+        yield from asyncio.gather(*tasks, loop=loop)
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_in_flight_counted_on_dispatch(loop):
+    seen = []
+
+    class Selector(LeastConnectionsSelector):
+        def select(self, connections):
+            seen.append(sum(c.in_flight for c in connections))
+            return super().select(connections)
+
+    tr = Transport(['h1', 'h2'], loop=loop, selector_factory=Selector)
+    fut = asyncio.Future(loop=loop)
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, **kwargs):
+        yield from fut
+        return 200, {}, ''
+
+    try:
+        for conn in tr._pool.connections:
+            conn.perform_request = perform_request
+        # wait_for() runs requests as tasks on the next loop iteration
+        tasks = [asyncio.ensure_future(
+            tr.perform_request('GET', '/', request_timeout=10),
+            loop=loop) for i in range(4)]
+        yield from asyncio.sleep(0.01, loop=loop)
+        assert [0, 1, 2, 3] == seen
+        assert [2, 2] == [c.in_flight for c in tr._pool.connections]
+        fut.set_result(None)
+        yield from asyncio.gather(*tasks, loop=loop)
+        assert [0, 0] == [c.in_flight for c in tr._pool.connections]
+    finally:
+        tr.close()
+
+
+def test_per_node_limits(loop):
+    tr = Transport(['h1', 'h2'], loop=loop, max_connections_per_node=3,
+                   max_pending_per_node=10)
+    try:
+        for conn in tr._pool.connections:
+            assert 3 == conn.max_connections
+            assert 10 == conn.max_pending
+    finally:
+        tr.close()
+
+
+def test_shared_session(loop):
+    calls = []
+
+    def connector_factory():
+        calls.append(1)
+        return aiohttp.TCPConnector(loop=loop)
+
+    tr = Transport(['h1', 'h2'], loop=loop,
+                   connector_factory=connector_factory)
+    tr.endpoints = ['h2', 'h3']
+    try:
+        assert [1] == calls
+        for conn in tr._pool.connections:
+            assert conn._session is tr._session
+    finally:
+        tr.close()
+    assert tr._session.closed
+
+
+def test_shared_session_default_connector(loop):
+    tr = Transport(['h1'], loop=loop)
+    try:
+        assert not tr._session.connector.limit
+        assert 100 == tr._session.connector.limit_per_host
+    finally:
+        tr.close()
+
+
+def test_shared_session_connector_per_node_limit(loop):
+    tr = Transport(['h1'], loop=loop, max_connections_per_node=5)
+    try:
+        assert 5 == tr._session.connector.limit_per_host
+    finally:
+        tr.close()
+
+
+def _responses(tr, loop, *responses):
+    calls = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, **kwargs):
+        calls.append((method, url))
+        resp = responses[len(calls) - 1]
+        if isinstance(resp, BaseException):
+            raise resp
+        return 200, {}, resp
+
+    for conn in tr._pool.connections:
+        conn.perform_request = perform_request
+    return calls
+
+
+@asyncio.coroutine
+def test_retry_on_status(loop):
+    policy = RetryPolicy(initial_backoff=0.001)
+    tr = Transport(['localhost'], loop=loop, retry_policy=policy)
+    try:
+        assert policy is tr.retry_policy
+        calls = _responses(tr, loop, TransportError(503, 'err', None),
+                           TransportError(502, 'err', None), '{"a": 1}')
+        status, data = yield from tr.perform_request('GET', '/')
+        assert {'a': 1} == data
+        assert 3 == len(calls)
+        # not marked as dead
+        assert 1 == len(tr._pool.connections)
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_retry_not_idempotent(loop):
+    tr = Transport(['localhost'], loop=loop)
+    try:
+        calls = _responses(tr, loop, TransportError(503, 'err', None))
+        with pytest.raises(TransportError):
+            yield from tr.perform_request('POST', '/_bulk', body=b'')
+        assert 1 == len(calls)
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_retry_exhausted(loop):
+    policy = RetryPolicy(2, initial_backoff=0.001)
+    tr = Transport(['localhost'], loop=loop, retry_policy=policy)
+    try:
+        assert 2 == tr.max_retries
+        calls = _responses(tr, loop, *[TransportError(503, 'err', None)] * 3)
+        with pytest.raises(TransportError):
+            yield from tr.perform_request('GET', '/')
+        assert 3 == len(calls)
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_retry_on_timeout(loop):
+    policy = RetryPolicy(initial_backoff=0.001, retry_on_timeout=True)
+    tr = Transport(['localhost'], loop=loop, retry_policy=policy)
+    try:
+        calls = _responses(tr, loop, asyncio.TimeoutError(), '{}')
+        status, data = yield from tr.perform_request('GET', '/')
+        assert 2 == len(calls)
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_retry_connect_error(loop):
+    tr = Transport(['h1', 'h2'], loop=loop,
+                   retry_policy=RetryPolicy(initial_backoff=0.001))
+    tr._min_sniff_interval = 1000
+    tr._last_sniff_attempt = time.monotonic()
+    try:
+        exc = ConnectionError('N/A', 'err',
+                              aiohttp.ClientConnectorError(111, 'refused'))
+        calls = _responses(tr, loop, exc, '{}')
+        status, data = yield from tr.perform_request('POST', '/_bulk',
+                                                     body=b'')
+        assert 2 == len(calls)
+        assert 1 == len(tr._pool.connections)
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_retry_budget(loop):
+    budget = RetryBudget(0.5, min_retries_per_sec=0)
+    tr = Transport(['localhost'], loop=loop, retry_budget=budget,
+                   retry_policy=RetryPolicy(initial_backoff=0.001))
+    try:
+        assert budget is tr.retry_budget
+        calls = _responses(tr, loop, TransportError(503, 'err', None),
+                           TransportError(503, 'err', None), '{}')
+        # 0.5 tokens, not enough for a retry
+        with pytest.raises(TransportError):
+            yield from tr.perform_request('GET', '/')
+        assert 1 == len(calls)
+        # 1 token after the second request
+        status, data = yield from tr.perform_request('GET', '/')
+        assert 3 == len(calls)
+        assert 0 == budget.tokens
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_circuit_breaker(loop):
+    tr = Transport(
+        ['h1', 'h2'], loop=loop,
+        retry_policy=RetryPolicy(0),
+        circuit_breaker_factory=lambda: CircuitBreaker(min_requests=2))
+    hosts = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, *, conn, **kwargs):
+        hosts.append(conn.endpoint.host)
+        if conn.endpoint.host == 'h1':
+            raise TransportError(503, 'unavailable', None)
+        if url == '/missing':
+            raise TransportError(404, 'not found', None)
+        return 200, {}, '{}'
+
+    try:
+        for conn in tr._pool.connections:
+            conn.perform_request = functools.partial(perform_request,
+                                                     conn=conn)
+        for i in range(4):
+            try:
+                yield from tr.perform_request('GET', '/')
+            except TransportError:
+                pass
+        with pytest.raises(TransportError):
+            yield from tr.perform_request('GET', '/missing')
+        assert ['h1', 'h1'] == [h for h in hosts if h == 'h1']
+        h1 = [c for c in tr._pool.connections if c.endpoint.host == 'h1'][0]
+        h2 = [c for c in tr._pool.connections if c.endpoint.host == 'h2'][0]
+        assert CircuitBreaker.OPEN == tr._pool.circuit_breaker(h1).state
+        assert CircuitBreaker.CLOSED == tr._pool.circuit_breaker(h2).state
+        del hosts[:]
+        for i in range(4):
+            yield from tr.perform_request('GET', '/')
+        assert ['h2'] * 4 == hosts
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_circuit_breaker_cancelled_probes(loop):
+    tr = Transport(
+        ['h1', 'h2'], loop=loop,
+        retry_policy=RetryPolicy(0),
+        circuit_breaker_factory=lambda: CircuitBreaker(
+            min_requests=1, reset_timeout=0.01, half_open_requests=1))
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, **kwargs):
+        yield from asyncio.sleep(10, loop=loop)
+
+    try:
+        for conn in tr._pool.connections:
+            conn.perform_request = perform_request
+        h1 = tr._pool.connections[0]
+        tr._pool.observe_failure(h1)
+        breaker = tr._pool.circuit_breaker(h1)
+        yield from asyncio.sleep(0.02, loop=loop)
+        tasks = [asyncio.ensure_future(tr.perform_request('GET', '/'),
+                                       loop=loop) for i in range(4)]
+        yield from asyncio.sleep(0.01, loop=loop)
+        assert 1 == breaker._probes
+        for task in tasks:
+            task.cancel()
+        yield from asyncio.gather(*tasks, loop=loop, return_exceptions=True)
+        # probe slot is given back, the node is not drained for good
+        assert 0 == breaker._probes
+        assert breaker.available()
+        assert h1 in tr._pool._available
+    finally:
+        tr.close()
+
+
+def _hedge_transport(loop, delays, **kwargs):
+    policy = HedgePolicy(min_samples=1, min_delay=0.01, max_ratio=1)
+    policy.observe(0.01)
+    tr = Transport(['h1', 'h2'], loop=loop, hedge_policy=policy, **kwargs)
+    calls = []
+    cancelled = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, *, delay, name, **kw):
+        calls.append(name)
+        try:
+            yield from asyncio.sleep(delay, loop=loop)
+        except asyncio.CancelledError:
+            cancelled.append(name)
+            raise
+        return 200, {}, '"{}"'.format(name)
+
+    # delays are given in order connections are selected by round robin
+    conns = tr._pool.connections[1:] + tr._pool.connections[:1]
+    for i, (conn, delay) in enumerate(zip(conns, delays)):
+        conn.perform_request = functools.partial(
+            perform_request, delay=delay, name='c{}'.format(i))
+    return tr, calls, cancelled
+
+
+@asyncio.coroutine
+def test_hedge(loop):
+    tr, calls, cancelled = _hedge_transport(loop, [10, 0])
+    observed = []
+    tr._pool.observe = lambda conn, elapsed: observed.append(elapsed)
+    try:
+        assert isinstance(tr.hedge_policy, HedgePolicy)
+        status, data = yield from tr.perform_request('GET', '/',
+                                                     hedge=True)
+        assert 'c1' == data
+        # latency of the hedge itself, without the hedge delay
+        assert observed[0] < 0.01
+        assert ['c0', 'c1'] == calls
+        yield from asyncio.sleep(0, loop=loop)
+        assert ['c0'] == cancelled
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_hedge_primary_wins(loop):
+    tr, calls, cancelled = _hedge_transport(loop, [0.03, 10])
+    try:
+        status, data = yield from tr.perform_request('GET', '/',
+                                                     hedge=True)
+        assert 'c0' == data
+        assert ['c0', 'c1'] == calls
+        yield from asyncio.sleep(0, loop=loop)
+        assert ['c1'] == cancelled
+        assert [0, 0] == [c.in_flight for c in tr._pool.connections]
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_hedge_not_requested(loop):
+    tr, calls, cancelled = _hedge_transport(loop, [0.03, 0.03])
+    try:
+        yield from tr.perform_request('GET', '/')
+        yield from tr.perform_request('POST', '/_bulk', body=b'',
+                                      hedge=True)
+        assert ['c0', 'c1'] == calls
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_hedge_no_samples(loop):
+    tr, calls, cancelled = _hedge_transport(loop, [0.03, 0.03])
+    tr.hedge_policy._samples.clear()
+    try:
+        yield from tr.perform_request('GET', '/', hedge=True)
+        assert ['c0'] == calls
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_hedge_budget(loop):
+    tr, calls, cancelled = _hedge_transport(loop, [0.03, 0.03])
+    tr.hedge_policy._budget = RetryBudget(0.5, min_retries_per_sec=0)
+    try:
+        yield from tr.perform_request('GET', '/', hedge=True)
+        assert ['c0'] == calls
+        yield from tr.perform_request('GET', '/', hedge=True)
+        assert ['c0', 'c1', 'c0'] == calls
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_hedge_failed_leg(loop):
+    tr, calls, cancelled = _hedge_transport(loop, [10, 0.03],
+                                            retry_policy=RetryPolicy(0))
+
+    @asyncio.coroutine
+    def failing(method, url, params, body, **kwargs):
+        calls.append('failed')
+        yield from asyncio.sleep(0.02, loop=loop)
+        raise TransportError(503, 'unavailable', None)
+
+    tr._pool.connections[1].perform_request = failing
+    try:
+        status, data = yield from tr.perform_request('GET', '/',
+                                                     hedge=True)
+        assert 'c1' == data
+        assert ['failed', 'c1'] == calls
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_hedge_failed_leg_doesnt_wait_sniff(loop):
+    tr, calls, cancelled = _hedge_transport(loop, [10, 0.03],
+                                            retry_policy=RetryPolicy(0))
+
+    @asyncio.coroutine
+    def failing(method, url, params, body, **kwargs):
+        yield from asyncio.sleep(0.02, loop=loop)
+        raise ConnectionError('N/A', 'refused', None)
+
+    @asyncio.coroutine
+    def sniff():
+        yield from asyncio.sleep(10, loop=loop)
+        raise TransportError('N/A', 'Unable to sniff hosts.')
+
+    tr._pool.connections[1].perform_request = failing
+    tr._sniff = sniff
+    try:
+        started = time.monotonic()
+        status, data = yield from tr.perform_request('GET', '/',
+                                                     hedge=True)
+        assert 'c1' == data
+        assert time.monotonic() - started < 1
+        # the failed connection is dead, sniffing goes on in background
+        assert 1 == len(tr._pool.connections)
+        assert tr._sniffing is not None
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_deadline_retries(loop):
+    policy = RetryPolicy(100, initial_backoff=0.01, max_backoff=0.01)
+    tr = Transport(['localhost'], loop=loop, retry_policy=policy)
+    try:
+        calls = _responses(tr, loop,
+                           *[TransportError(503, 'err', None)] * 100)
+        started = time.monotonic()
+        with pytest.raises(TransportError):
+            yield from tr.perform_request('GET', '/',
+                                          deadline=started + 0.05)
+        assert time.monotonic() - started < 0.1
+        assert 1 < len(calls) < 100
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_deadline_cuts_attempt(loop):
+    tr = Transport(['localhost'], loop=loop)
+    failures = []
+    tr._pool.observe_failure = failures.append
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, **kwargs):
+        yield from asyncio.sleep(10, loop=loop)
+
+    try:
+        tr._pool.connections[0].perform_request = perform_request
+        started = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            yield from tr.perform_request('GET', '/', request_timeout=10,
+                                          deadline=started + 0.02)
+        assert time.monotonic() - started < 1
+        # the node isn't blamed for the caller's deadline
+        assert [] == failures
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_deadline_expired(loop):
+    tr = Transport(['localhost'], loop=loop)
+    try:
+        calls = _responses(tr, loop, '{}')
+        with pytest.raises(asyncio.TimeoutError):
+            yield from tr.perform_request('GET', '/',
+                                          deadline=time.monotonic())
+        assert [] == calls
+    finally:
+        tr.close()
+
+
+@asyncio.coroutine
+def test_deadline_server_timeout(loop):
+    tr = Transport(['localhost'], loop=loop)
+    sent = []
+
+    @asyncio.coroutine
+    def perform_request(method, url, params, body, **kwargs):
+        sent.append(dict(params or {}))
+        return 200, {}, '{}'
+
+    try:
+        tr._pool.connections[0].perform_request = perform_request
+        deadline = time.monotonic() + 2
+        yield from tr.perform_request('GET', '/index/_search',
+                                      deadline=deadline)
+        yield from tr.perform_request('POST', '/_bulk', body=b'',
+                                      deadline=deadline)
+        yield from tr.perform_request('GET', '/index/_search',
+                                      {'timeout': '1s'}, deadline=deadline)
+        yield from tr.perform_request('GET', '/index/doc/1',
+                                      deadline=deadline)
+        yield from tr.perform_request('GET', '/index/_search')
+        for params in sent[:2]:
+            assert params['timeout'].endswith('ms')
+            assert 1000 < int(params['timeout'][:-2]) <= 2000
+        assert {'timeout': '1s'} == sent[2]
+        assert {} == sent[3]
+        assert {} == sent[4]
+    finally:
+        tr.close()